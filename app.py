@@ -1,25 +1,229 @@
 # MouseFlowPractice/app.py
-from flask import Flask, request, jsonify, send_from_directory, render_template
+from flask import Flask, Response, g, request, jsonify, send_file, render_template, abort, url_for, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import datetime, os, pytz
+from sqlalchemy import event as sqla_event, func, case, or_, and_, select, inspect as sqla_inspect, text as sqla_text
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import OperationalError
+import atexit
+import click
+import concurrent.futures
+import contextlib
+import base64
+import bisect
+import cProfile
+import datetime, io, os, pytz
+import gzip
+import heapq
+import itertools
 import json
+import math
+import multiprocessing.util
+import queue
+import re
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import uuid
+import zlib
 import cv2
 import numpy as np
 from selenium import webdriver
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.common.exceptions import TimeoutException
 from webdriver_manager.chrome import ChromeDriverManager
 import time
+import trio
+import trio_websocket
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
 basedir = os.path.abspath(os.path.dirname(__file__))
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'db.sqlite3')
+
+PKT = pytz.timezone('Asia/Karachi')
+
+# Connections kept per worker process; SQLite gets one per thread from the same pool
+DB_POOL_SIZE = int(os.environ.get('MOUSEFLOW_DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('MOUSEFLOW_DB_MAX_OVERFLOW', 10))
+DB_POOL_RECYCLE = int(os.environ.get('MOUSEFLOW_DB_POOL_RECYCLE', 1800))
+# Event batches at least this large go through COPY on PostgreSQL
+COPY_MIN_ROWS = 200
+
+def database_url():
+    url = (os.environ.get('MOUSEFLOW_DATABASE_URL') or os.environ.get('DATABASE_URL')
+           or 'sqlite:///' + os.path.join(basedir, 'db.sqlite3'))
+    # Hosting providers still hand out the postgres:// scheme SQLAlchemy no longer accepts
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+def engine_options(url):
+    url = make_url(url)
+    if url.get_backend_name() == 'sqlite':
+        if not url.database or url.database == ':memory:':
+            return {}
+        return {'pool_size': DB_POOL_SIZE, 'max_overflow': DB_MAX_OVERFLOW}
+    options = {'pool_size': DB_POOL_SIZE, 'max_overflow': DB_MAX_OVERFLOW,
+               'pool_recycle': DB_POOL_RECYCLE, 'pool_pre_ping': True}
+    if url.get_backend_name() == 'postgresql':
+        # Timestamps are stored as naive Karachi wall time, the same as SQLite stores them
+        options['connect_args'] = {'options': f'-c timezone={PKT.zone}'}
+    return options
+
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 db = SQLAlchemy(app)
 CORS(app)
 
-PKT = pytz.timezone('Asia/Karachi')
+# WAL lets the dashboard read while /collect writes; NORMAL sync is durable enough under WAL
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'temp_store': 'MEMORY',
+    'cache_size': -20000,
+    'busy_timeout': 5000,
+}
+
+# /collect hands batches to a single writer thread that commits them together
+INGEST_ASYNC = os.environ.get('MOUSEFLOW_INGEST_ASYNC', '1') != '0'
+INGEST_FLUSH_INTERVAL = float(os.environ.get('MOUSEFLOW_INGEST_FLUSH_MS', 250)) / 1000.0
+INGEST_FLUSH_EVENTS = int(os.environ.get('MOUSEFLOW_INGEST_FLUSH_EVENTS', 5000))
+INGEST_QUEUE_SIZE = int(os.environ.get('MOUSEFLOW_INGEST_QUEUE_SIZE', 1000))
+# Writes failing with an OperationalError (SQLite's "database is locked", a PostgreSQL deadlock or
+# dropped connection) are retried this many times, waiting INGEST_RETRY_DELAY seconds, then twice as long each time
+INGEST_WRITE_RETRIES = int(os.environ.get('MOUSEFLOW_INGEST_WRITE_RETRIES', 5))
+INGEST_RETRY_DELAY = 0.5
+
+# Largest /collect body accepted after gzip decompression
+COLLECT_MAX_BODY = 16 * 1024 * 1024
+COMPACT_FORMAT_VERSION = 2
+# Largest accepted |x| or |y|; keeps the deltas in packed mousemove chunks within int32
+EVENT_COORDINATE_LIMIT = 10 ** 9
+# Accepted event timestamps around the server clock: room for a tracker that retried a batch for a while,
+# and for a visitor's clock being off by up to a day. Also keeps a batch's time span within int32 milliseconds
+EVENT_MAX_AGE = datetime.timedelta(days=float(os.environ.get('MOUSEFLOW_EVENT_MAX_AGE_DAYS', 7)))
+EVENT_MAX_AHEAD = datetime.timedelta(days=1)
+
+# 'packed' stores each batch's mousemoves as one delta-encoded MoveChunk blob; 'rows' keeps one Event per point
+MOVE_STORAGE = os.environ.get('MOUSEFLOW_MOVE_STORAGE', 'packed')
+MOVE_CHUNK_MAX_POINTS = 10000
+# Packed deltas are int32, so a gap of more than ~24.8 days between two points starts a new chunk
+MOVE_DELTA_LIMIT = 2 ** 31 - 1
+
+# Batches carrying the same tracker token join one session until it goes idle this long
+SESSION_IDLE_TIMEOUT = datetime.timedelta(minutes=float(os.environ.get('MOUSEFLOW_SESSION_IDLE_MINUTES', 30)))
+SESSION_TOKEN_MAX_LENGTH = 64
+
+VIDEO_DIR = os.path.join('static', 'videos')
+# Filename suffixes older renderers used, in the order the dashboard used to prefer them
+VIDEO_VARIANTS = ['', '_simple', '_real_browser', '_composite']
+# A poster and a hover-scrub sprite are written while each video is encoded, so listing sessions never loads videos
+THUMBNAIL_DIR = os.path.join(VIDEO_DIR, 'thumbs')
+POSTER_WIDTH = 320
+SPRITE_FRAMES = 12
+SPRITE_FRAME_WIDTH = 160
+THUMBNAIL_JPEG_QUALITY = 80
+# '' sends rendered files from Flask; 'x-sendfile' (Apache, lighttpd) or 'x-accel-redirect' (nginx) leaves it to the proxy
+MEDIA_SENDFILE_MODES = ['', 'x-sendfile', 'x-accel-redirect']
+MEDIA_SENDFILE = os.environ.get('MOUSEFLOW_SENDFILE', '').lower()
+if MEDIA_SENDFILE not in MEDIA_SENDFILE_MODES:
+    raise ValueError(f'MOUSEFLOW_SENDFILE must be one of {MEDIA_SENDFILE_MODES[1:]}, got {MEDIA_SENDFILE!r}')
+# nginx internal location that maps onto VIDEO_DIR
+MEDIA_ACCEL_PREFIX = os.environ.get('MOUSEFLOW_ACCEL_PREFIX', '/_media/')
+# A ?v= that matches the current render names bytes that never change, so browsers may keep them this long
+MEDIA_MAX_AGE = 365 * 24 * 3600
+
+VIEWPORT_WIDTH, VIEWPORT_HEIGHT = 1280, 720
+MAX_TRAIL_LENGTH = 30
+TRAIL_FADE_STEPS = 6
+TRAIL_COLORS = {'mousemove': (100, 255, 100), 'click': (255, 100, 100), 'scroll': (100, 100, 255)}
+# Cursor sprites are pre-rendered on a canvas this size (rows, cols), with the pointer at (x, y) = anchor
+CURSOR_SPRITE_SHAPE = (50, 140)
+CURSOR_SPRITE_ANCHOR = (20, 30)
+# Full-page screenshots reused by the composite renderer, one per session
+PAGE_CACHE_DIR = os.path.join(VIDEO_DIR, 'pages')
+PAGE_CAPTURE_MAX_HEIGHT = 16384
+RENDER_MODES = ['composite', 'real_browser']
+RENDER_FPS = 15
+# Output size, frame rate and idle compression per preset; idle_gap is the longest pause (seconds)
+# rendered in full before it is collapsed into a short "skipped" card, None to keep every pause
+RENDER_PRESETS = {
+    'preview': {'width': 640, 'height': 360, 'fps': 8, 'idle_gap': 2.0},
+    'standard': {'width': 1280, 'height': 720, 'fps': RENDER_FPS, 'idle_gap': 5.0},
+    'full': {'width': 1280, 'height': 720, 'fps': 30, 'idle_gap': None},
+}
+DEFAULT_RENDER_PRESET = 'standard'
+RENDER_MAX_FPS = 30
+# A collapsed pause keeps this much of its start and end, with the card shown for IDLE_CARD_SECONDS between
+IDLE_HOLD_SECONDS = 0.5
+IDLE_CARD_SECONDS = 1.0
+RENDER_WORKERS = int(os.environ.get('MOUSEFLOW_RENDER_WORKERS', 2))
+# Finished jobs stay visible to /jobs/<id> for this long
+RENDER_JOB_TTL = 3600
+# The process holding a job refreshes it this often; one not refreshed for RENDER_JOB_STALE seconds is failed
+RENDER_JOB_HEARTBEAT = 10
+RENDER_JOB_STALE = 60
+# Frame progress is written to the job row at most this often
+RENDER_PROGRESS_INTERVAL = 1.0
+# Warm headless Chrome instances shared by render jobs; each is recycled after CHROME_MAX_JOBS renders
+CHROME_POOL_SIZE = int(os.environ.get('MOUSEFLOW_CHROME_POOL_SIZE', RENDER_WORKERS))
+CHROME_MAX_JOBS = int(os.environ.get('MOUSEFLOW_CHROME_MAX_JOBS', 20))
+# Each server process fills its Chrome pool on its first request; 0 launches Chrome only when a render needs it
+CHROME_WARM = os.environ.get('MOUSEFLOW_CHROME_WARM', '1') != '0'
+PAGE_READY_TIMEOUT = 15
+# 'screencast' streams JPEG frames and sends input over a second DevTools connection to the tab;
+# 'screenshot' takes a PNG screenshot per frame and replays input through WebDriver
+CAPTURE_BACKENDS = ['screencast', 'screenshot']
+CAPTURE_BACKEND = os.environ.get('MOUSEFLOW_CAPTURE_BACKEND', 'screencast')
+SCREENCAST_JPEG_QUALITY = int(os.environ.get('MOUSEFLOW_SCREENCAST_QUALITY', 80))
+# Seconds to wait for the DevTools connection and for the first screencast frame
+SCREENCAST_TIMEOUT = 10
+SCREENCAST_MAX_MESSAGE = 32 * 1024 * 1024
+
+# Per-URL heatmaps count mousemoves and clicks in HEATMAP_CELL-pixel squares of the viewport;
+# points outside HEATMAP_WIDTH x HEATMAP_HEIGHT land in the edge cells
+HEATMAP_EVENT_TYPES = ['mousemove', 'click']
+HEATMAP_CELL = 10
+HEATMAP_WIDTH, HEATMAP_HEIGHT = 1920, 1080
+HEATMAP_SHAPE = (HEATMAP_HEIGHT // HEATMAP_CELL, HEATMAP_WIDTH // HEATMAP_CELL)
+# The overlay is a blur, so half resolution scales up fine and encodes 4x faster
+HEATMAP_PNG_WIDTH = 960
+
+SESSIONS_PER_PAGE = 50
+SESSIONS_MAX_PER_PAGE = 500
+# Rows fetched per round trip, and events per write, when streaming GET /session/<id>
+SESSION_STREAM_BATCH = 1000
+
+# Upper bounds (seconds) of the /metrics histogram buckets, from a per-frame stage up to a whole render
+METRIC_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# Set it when running several server processes: each writes its metrics to a file here every
+# METRICS_FLUSH_INTERVAL seconds and /metrics adds up all of them. Empty it before starting the server
+METRICS_DIR = os.environ.get('MOUSEFLOW_METRICS_DIR')
+METRICS_FLUSH_INTERVAL = 5
+# flask render-videos --profile and ?profile=1 write one cProfile dump per render here
+PROFILE_DIR = os.environ.get('MOUSEFLOW_PROFILE_DIR', os.path.join(basedir, 'profiles'))
+
+# flask retention: mousemoves older than DOWNSAMPLE_DAYS keep one point per DOWNSAMPLE_MS, and sessions
+# older than ARCHIVE_DAYS move to gzipped NDJSON files in ARCHIVE_DIR; 0 days turns a policy off
+RETENTION_DOWNSAMPLE_DAYS = float(os.environ.get('MOUSEFLOW_DOWNSAMPLE_DAYS', 0))
+RETENTION_DOWNSAMPLE_MS = int(os.environ.get('MOUSEFLOW_DOWNSAMPLE_MS', 200))
+RETENTION_ARCHIVE_DAYS = float(os.environ.get('MOUSEFLOW_ARCHIVE_DAYS', 0))
+ARCHIVE_DIR = os.environ.get('MOUSEFLOW_ARCHIVE_DIR', os.path.join(basedir, 'archive'))
+# Sessions handled per transaction, so the writer thread never waits long on the lock
+RETENTION_BATCH = int(os.environ.get('MOUSEFLOW_RETENTION_BATCH', 50))
+
+@sqla_event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
 
 # MODELS
 class Session(db.Model):
@@ -27,74 +231,901 @@ class Session(db.Model):
     ip_address = db.Column(db.String(100))
     user_agent = db.Column(db.String(255))
     url = db.Column(db.String(500), nullable=True)
-    timestamp = db.Column(db.DateTime, default=lambda: datetime.datetime.now(PKT))
+    token = db.Column(db.String(SESSION_TOKEN_MAX_LENGTH), nullable=True)
+    timestamp = db.Column(db.DateTime, default=lambda: datetime.datetime.now(PKT), index=True)
+    last_seen = db.Column(db.DateTime, default=lambda: datetime.datetime.now(PKT))
+    __table_args__ = (db.Index('ix_session_token_last_seen', 'token', 'last_seen'),)
     events = db.relationship('Event', backref='session', lazy=True, cascade="all, delete-orphan")
+    video = db.relationship('Video', backref='session', uselist=False, lazy=True, cascade="all, delete-orphan")
+    move_chunks = db.relationship('MoveChunk', backref='session', lazy=True, cascade="all, delete-orphan")
+    downsampled = db.relationship('DownsampledSession', uselist=False, lazy=True, cascade="all, delete-orphan")
+
+# 64-bit ids on PostgreSQL; SQLite only autoincrements a column declared INTEGER
+EventId = db.BigInteger().with_variant(db.Integer(), 'sqlite')
 
 class Event(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(EventId, primary_key=True)
     session_id = db.Column(db.Integer, db.ForeignKey('session.id'), nullable=False)
     event_type = db.Column(db.String(50))
     timestamp = db.Column(db.DateTime, default=lambda: datetime.datetime.now(PKT))
     x = db.Column(db.Integer, nullable=True)
     y = db.Column(db.Integer, nullable=True)
     additional_data = db.Column(db.Text, nullable=True)
+    __table_args__ = (db.Index('ix_event_session_id_timestamp', 'session_id', 'timestamp'),)
+
+class MoveChunk(db.Model):
+    id = db.Column(EventId, primary_key=True)
+    session_id = db.Column(db.Integer, db.ForeignKey('session.id'), nullable=False)
+    start_time = db.Column(db.DateTime, nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+    # zlib-compressed little-endian int32 array of shape (3, count): per-point deltas of t (ms), x and y
+    data = db.Column(db.LargeBinary, nullable=False)
+    __table_args__ = (db.Index('ix_move_chunk_session_id_start_time', 'session_id', 'start_time'),)
+
+# Sessions whose old mousemoves flask retention has already thinned out
+class DownsampledSession(db.Model):
+    session_id = db.Column(db.Integer, db.ForeignKey('session.id'), primary_key=True)
+    interval_ms = db.Column(db.Integer, nullable=False)
+    downsampled_at = db.Column(db.DateTime, default=lambda: datetime.datetime.now(PKT))
+
+def pack_moves(points):
+    """Yield (start_time, count, data) for each MoveChunk needed to hold the (timestamp, x, y) points."""
+    points = sorted(points, key=lambda p: p[0])
+    start_time = points[0][0]
+    columns = np.array([
+        [round((t - start_time).total_seconds() * 1000) for t, _, _ in points],
+        [int(x or 0) for _, x, _ in points],
+        [int(y or 0) for _, _, y in points]
+    ], dtype=np.int64)
+    for start_ms, part in split_move_columns(columns):
+        yield start_time + datetime.timedelta(milliseconds=start_ms), part.shape[1], pack_move_columns(part)
+
+def split_move_columns(columns):
+    # columns is (3, count) sorted by t; yields (start_ms, part) with part's t rebased to its first point
+    gaps = np.flatnonzero(np.diff(columns[0]) > MOVE_DELTA_LIMIT) + 1
+    for segment in np.split(columns, gaps, axis=1):
+        for i in range(0, segment.shape[1], MOVE_CHUNK_MAX_POINTS):
+            part = segment[:, i:i + MOVE_CHUNK_MAX_POINTS].copy()
+            start_ms = int(part[0, 0])
+            part[0] -= start_ms
+            yield start_ms, part
+
+def pack_move_columns(columns):
+    # columns is (3, count): t in ms from the chunk start, x and y
+    deltas = np.diff(columns, axis=1, prepend=0)
+    if deltas.size and np.abs(deltas).max() > MOVE_DELTA_LIMIT:
+        raise ValueError('mousemove deltas do not fit in int32')
+    return zlib.compress(deltas.astype('<i4').tobytes(), 1)
+
+def unpack_moves(chunk):
+    deltas = np.frombuffer(zlib.decompress(chunk.data), dtype='<i4').reshape(3, chunk.count)
+    t_ms, x, y = np.cumsum(deltas, axis=1, dtype=np.int64)
+    return t_ms, x, y
+
+class PackedMove:
+    __slots__ = ('timestamp', 'x', 'y')
+    event_type = 'mousemove'
+    additional_data = None
+
+    def __init__(self, timestamp, x, y):
+        self.timestamp = timestamp
+        self.x = x
+        self.y = y
+
+class SessionEvents:
+    """Time-ordered view over a session's Event rows and packed mousemoves.
+
+    Packed points stay in NumPy arrays and only become PackedMove objects when indexed.
+    """
+
+    def __init__(self, rows, chunks):
+        decoded = [(chunk.start_time, unpack_moves(chunk)) for chunk in chunks]
+        starts = [row.timestamp for row in rows[:1]] + [start for start, _ in decoded]
+        self.base_time = min(starts) if starts else None
+        self.rows = rows
+        offsets = [np.array([(row.timestamp - self.base_time).total_seconds() for row in rows], dtype=np.float64)]
+        row_index = [np.arange(len(rows), dtype=np.int64)]
+        xs = [np.zeros(len(rows), dtype=np.int64)]
+        ys = [np.zeros(len(rows), dtype=np.int64)]
+        for start, (t_ms, x, y) in decoded:
+            offsets.append((start - self.base_time).total_seconds() + t_ms / 1000.0)
+            row_index.append(np.full(len(t_ms), -1, dtype=np.int64))
+            xs.append(x)
+            ys.append(y)
+        offsets = np.concatenate(offsets)
+        order = np.argsort(offsets, kind='stable')
+        self.offsets = offsets[order]
+        self.row_index = np.concatenate(row_index)[order]
+        self.x = np.concatenate(xs)[order]
+        self.y = np.concatenate(ys)[order]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        row_idx = self.row_index[index]
+        if row_idx >= 0:
+            return self.rows[row_idx]
+        timestamp = self.base_time + datetime.timedelta(seconds=float(self.offsets[index]))
+        return PackedMove(timestamp, int(self.x[index]), int(self.y[index]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+def load_session_events(session_id):
+    rows = Event.query.filter_by(session_id=session_id).order_by(Event.timestamp, Event.id).all()
+    chunks = MoveChunk.query.filter_by(session_id=session_id).order_by(MoveChunk.start_time).all()
+    if not chunks:
+        return rows
+    return SessionEvents(rows, chunks)
+
+def stream_event_rows(session_id, since=None, types=None):
+    query = select(Event.event_type, Event.timestamp, Event.x, Event.y, Event.additional_data).where(
+        Event.session_id == session_id)
+    if since:
+        query = query.where(Event.timestamp >= since)
+    if types is not None:
+        query = query.where(Event.event_type.in_(types))
+    query = query.order_by(Event.timestamp, Event.id).execution_options(yield_per=SESSION_STREAM_BATCH)
+    for row in db.session.execute(query):
+        yield tuple(row)
+
+def stream_packed_moves(session_id, since=None):
+    # Chunks are ordered by start time but may overlap, so a decoded point is held back
+    # until no later chunk can start before it
+    query = select(MoveChunk).where(MoveChunk.session_id == session_id).order_by(
+        MoveChunk.start_time, MoveChunk.id).execution_options(yield_per=8)
+    base_time = None
+    pending = np.empty((3, 0), dtype=np.int64)
+
+    def emit(points):
+        for t_ms, x, y in points.T.tolist():
+            yield ('mousemove', base_time + datetime.timedelta(milliseconds=t_ms), x, y, None)
+
+    for chunk in db.session.execute(query).scalars():
+        if base_time is None:
+            base_time = chunk.start_time
+        start_ms = round((chunk.start_time - base_time).total_seconds() * 1000)
+        points = np.stack(unpack_moves(chunk))
+        points[0] += start_ms
+        if since:
+            points = points[:, points[0] >= round((since - base_time).total_seconds() * 1000)]
+        # Taken from the chunk's start rather than its first point left after ?since=, which may be none
+        ready = pending[0] < start_ms
+        yield from emit(pending[:, ready])
+        pending = np.concatenate([pending[:, ~ready], points], axis=1)
+        pending = pending[:, np.argsort(pending[0], kind='stable')]
+    if base_time is not None:
+        yield from emit(pending)
+
+def stream_session_events(session_id, since=None, types=None, limit=None):
+    """Yield (event_type, timestamp, x, y, additional_data) tuples in time order without loading the session."""
+    streams = [stream_event_rows(session_id, since, types)]
+    if types is None or 'mousemove' in types:
+        streams.append(stream_packed_moves(session_id, since))
+    return itertools.islice(heapq.merge(*streams, key=lambda evt: evt[1]), limit)
+
+class Heatmap(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    url = db.Column(db.String(500), nullable=False)
+    event_type = db.Column(db.String(50), nullable=False)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    # zlib-compressed little-endian uint32 counts of shape HEATMAP_SHAPE
+    data = db.Column(db.LargeBinary, nullable=False)
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.datetime.now(PKT))
+    __table_args__ = (db.UniqueConstraint('url', 'event_type'),)
+
+    @property
+    def grid(self):
+        return np.frombuffer(zlib.decompress(self.data), dtype='<u4').reshape(HEATMAP_SHAPE)
+
+    @grid.setter
+    def grid(self, counts):
+        self.data = zlib.compress(counts.astype('<u4').tobytes(), 1)
+
+def bin_points(x, y):
+    cols = np.clip(np.asarray(x, dtype=np.int64) // HEATMAP_CELL, 0, HEATMAP_SHAPE[1] - 1)
+    rows = np.clip(np.asarray(y, dtype=np.int64) // HEATMAP_CELL, 0, HEATMAP_SHAPE[0] - 1)
+    cells = np.bincount(rows * HEATMAP_SHAPE[1] + cols, minlength=HEATMAP_SHAPE[0] * HEATMAP_SHAPE[1])
+    return cells.reshape(HEATMAP_SHAPE)
+
+def add_to_heatmaps(counts):
+    """Add {(url, event_type): (grid, total)} to the stored heatmaps in the current transaction."""
+    existing = {(h.url, h.event_type): h for h in Heatmap.query.filter(Heatmap.url.in_({url for url, _ in counts}))}
+    now = datetime.datetime.now(PKT)
+    for (url, event_type), (grid, total) in counts.items():
+        heatmap = existing.get((url, event_type))
+        if heatmap is None:
+            heatmap = Heatmap(url=url, event_type=event_type, total=0)
+            db.session.add(heatmap)
+        else:
+            grid = grid + heatmap.grid
+        heatmap.grid = grid
+        heatmap.total += total
+        heatmap.updated_at = now
+
+def update_heatmaps(payloads):
+    # Keyed by the page each batch came from, which is also what rebuild-heatmaps reads back
+    # from Session.url now that a session never spans two pages
+    points = {}
+    for p in payloads:
+        if not p['url']:
+            continue
+        for row in p['rows']:
+            x, y = row['x'], row['y']
+            # type() rather than isinstance() so booleans from the tracker payload are skipped too
+            if row['event_type'] in HEATMAP_EVENT_TYPES and type(x) in (int, float) and type(y) in (int, float):
+                points.setdefault((p['url'], row['event_type']), []).append((x, y))
+    if points:
+        add_to_heatmaps({key: (bin_points(*np.array(coords, dtype=np.float64).T), len(coords))
+                         for key, coords in points.items()})
+
+class Video(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.Integer, db.ForeignKey('session.id'), nullable=False, unique=True)
+    filename = db.Column(db.String(255), nullable=False)
+    codec = db.Column(db.String(16), nullable=True)
+    size_bytes = db.Column(db.Integer, nullable=True)
+    duration_seconds = db.Column(db.Float, nullable=True)
+    generated_at = db.Column(db.DateTime, default=lambda: datetime.datetime.now(PKT))
+
+    @property
+    def path(self):
+        return os.path.join(VIDEO_DIR, self.filename)
+
+    @property
+    def url(self):
+        return f'/static/videos/{self.filename}'
+
+    @property
+    def version(self):
+        # Changes with every re-render, so URLs carrying it can be cached for good
+        return f'{self.generated_at:%Y%m%d%H%M%S%f}-{self.size_bytes}'
+
+    @property
+    def last_modified(self):
+        # Stored without a zone on SQLite and PostgreSQL alike; it was written in PKT
+        return PKT.localize(self.generated_at) if self.generated_at.tzinfo is None else self.generated_at
+
+def register_video(session_id, filename, codec=None, duration_seconds=None, generated_at=None):
+    video = Video.query.filter_by(session_id=session_id).first() or Video(session_id=session_id)
+    if video.filename and video.filename != filename:
+        remove_file(video.path)
+    video.filename = filename
+    video.codec = codec
+    video.size_bytes = os.path.getsize(os.path.join(VIDEO_DIR, filename))
+    video.duration_seconds = duration_seconds
+    video.generated_at = generated_at or datetime.datetime.now(PKT)
+    db.session.add(video)
+    db.session.commit()
+    return video
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def event_coordinate(value):
+    # type() rather than isinstance() so JSON booleans are rejected too
+    if value is None or (type(value) in (int, float) and math.isfinite(value) and abs(value) <= EVENT_COORDINATE_LIMIT):
+        return value
+    raise ValueError('coordinates must be numbers or null')
+
+def build_event_rows(raw_events):
+    if not isinstance(raw_events, list):
+        raise ValueError('events must be a list')
+    now = datetime.datetime.now(PKT)
+    earliest, latest = now - EVENT_MAX_AGE, now + EVENT_MAX_AHEAD
+    rows = []
+    for evt in raw_events:
+        try:
+            data = evt.get('data')
+            if data is not None and not isinstance(data, str):
+                raise ValueError('data must be a string or null')
+            rows.append({
+                'event_type': str(evt['type'])[:50],
+                'timestamp': datetime.datetime.fromtimestamp(float(evt['timestamp']) / 1000.0, tz=PKT),
+                'x': event_coordinate(evt.get('x')),
+                'y': event_coordinate(evt.get('y')),
+                'additional_data': data
+            })
+        except (KeyError, TypeError, ValueError, OverflowError, AttributeError):
+            raise ValueError(f'invalid event at index {len(rows)}')
+        if not earliest <= rows[-1]['timestamp'] <= latest:
+            raise ValueError(f'event at index {len(rows) - 1} is outside the accepted time window')
+    return rows
+
+def expand_compact_events(data):
+    types = data.get('types')
+    encoded = data.get('e')
+    t = data.get('t0')
+    if not isinstance(types, list) or not isinstance(encoded, list) or len(encoded) % 4:
+        raise ValueError('compact batch needs types, t0 and e with 4 values per event')
+    events = []
+    pointer = [0, 0]
+    scroll = [0, 0]
+    try:
+        for i in range(0, len(encoded), 4):
+            type_idx, dt, dx, dy = encoded[i:i + 4]
+            # Negative indexes and JSON booleans would otherwise pick a real type
+            if type(type_idx) is not int or not 0 <= type_idx < len(types):
+                raise IndexError(type_idx)
+            event_type = types[type_idx]
+            t += dt
+            position = scroll if event_type == 'scroll' else pointer
+            position[0] += dx
+            position[1] += dy
+            if event_type == 'scroll':
+                # Scroll positions arrive in hundredths of a percent
+                events.append({'type': event_type, 'timestamp': t, 'x': position[0] / 100, 'y': position[1] / 100})
+            else:
+                events.append({'type': event_type, 'timestamp': t, 'x': position[0], 'y': position[1]})
+    except (TypeError, IndexError):
+        raise ValueError(f'invalid compact event at index {i // 4}')
+    return events
+
+def read_collect_body():
+    body = request.get_data(cache=False)
+    if request.headers.get('Content-Encoding', '').lower() == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            body = decompressor.decompress(body, COLLECT_MAX_BODY)
+        except zlib.error:
+            raise ValueError('Invalid gzip body')
+        if decompressor.unconsumed_tail:
+            raise ValueError('Payload too large')
+    try:
+        return json.loads(body)
+    except ValueError:
+        return None
+
+def insert_events(session_id, rows):
+    if not rows:
+        return
+    if MOVE_STORAGE == 'packed':
+        moves = [(row['timestamp'], row['x'], row['y']) for row in rows if row['event_type'] == 'mousemove']
+        rows = [row for row in rows if row['event_type'] != 'mousemove']
+        for start_time, count, data in (pack_moves(moves) if moves else ()):
+            db.session.execute(MoveChunk.__table__.insert(), {
+                'session_id': session_id, 'start_time': start_time, 'count': count, 'data': data
+            })
+        if not rows:
+            return
+    for row in rows:
+        row['session_id'] = session_id
+    if len(rows) >= COPY_MIN_ROWS and db.session.get_bind().dialect.name == 'postgresql':
+        copy_event_rows(rows)
+    else:
+        db.session.execute(Event.__table__.insert(), rows)
+
+EVENT_COPY_COLUMNS = ['session_id', 'event_type', 'timestamp', 'x', 'y', 'additional_data']
+
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+def copy_event_rows(rows):
+    """Insert Event rows with COPY ... FROM STDIN on the session's own connection (psycopg 3 or psycopg2)."""
+    buffer = io.StringIO()
+    for row in rows:
+        # COPY does no casting, so coordinates that are not numbers are stored as NULL
+        row = dict(row, **{key: round(row[key]) if type(row[key]) in (int, float) else None for key in ('x', 'y')})
+        buffer.write('\t'.join(copy_value(row[column]) for column in EVENT_COPY_COLUMNS) + '\n')
+    connection = db.session.connection()
+    preparer = connection.dialect.identifier_preparer
+    statement = (f'COPY {preparer.format_table(Event.__table__)} '
+                 f'({", ".join(preparer.quote(column) for column in EVENT_COPY_COLUMNS)}) FROM STDIN')
+    cursor = connection.connection.cursor()
+    try:
+        if hasattr(cursor, 'copy_expert'):
+            buffer.seek(0)
+            cursor.copy_expert(statement, buffer)
+        else:
+            with cursor.copy(statement) as copy:
+                copy.write(buffer.getvalue())
+    finally:
+        cursor.close()
+
+def resolve_sessions(payloads):
+    tokens = {p['token'] for p in payloads if p['token']}
+    open_sessions = {}
+    if tokens:
+        cutoff = min(p['received_at'] for p in payloads) - SESSION_IDLE_TIMEOUT
+        recent = Session.query.filter(Session.token.in_(tokens), Session.last_seen >= cutoff).order_by(Session.last_seen)
+        for session in recent:
+            open_sessions[session.token] = session
+    sessions = []
+    for p in payloads:
+        session = open_sessions.get(p['token']) if p['token'] else None
+        # The token lasts as long as the tab, but a session replays a single page, so navigating starts a new one
+        if session is not None and session.url != p['url']:
+            session = None
+        if session is None:
+            session = Session(
+                ip_address=p['ip_address'],
+                user_agent=p['user_agent'],
+                url=p['url'],
+                token=p['token'],
+                timestamp=p['received_at']
+            )
+            db.session.add(session)
+            if p['token']:
+                open_sessions[p['token']] = session
+        session.last_seen = p['received_at']
+        sessions.append(session)
+    db.session.flush()
+    return sessions
+
+# Any constants; held by whichever worker process is writing a batch or submitting a render on PostgreSQL
+INGEST_LOCK_KEY = 0x6d666c77
+RENDER_LOCK_KEY = 0x6d666c72
+
+def lock_for_write(key):
+    # SQLite must take its write lock up front: a transaction that reads and then writes fails
+    # with "database is locked" at once if another process wrote in between
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        db.session.execute(sqla_text('BEGIN IMMEDIATE'))
+    elif dialect == 'postgresql':
+        db.session.execute(select(func.pg_advisory_xact_lock(key)))
+
+def lock_for_ingest():
+    # Worker processes write one batch at a time, so two of them never create the same session or heatmap row
+    lock_for_write(INGEST_LOCK_KEY)
+
+def write_payloads(payloads):
+    lock_for_ingest()
+    sessions = resolve_sessions(payloads)
+    for session, p in zip(sessions, payloads):
+        insert_events(session.id, p['rows'])
+    update_heatmaps(payloads)
+    db.session.commit()
+
+def write_payloads_retrying(payloads):
+    for attempt in itertools.count():
+        try:
+            write_payloads(payloads)
+            return
+        except OperationalError as e:
+            db.session.rollback()
+            if attempt >= INGEST_WRITE_RETRIES:
+                raise
+            metrics.inc('mouseflow_ingest_write_retries_total')
+            app.logger.warning('Writing %d /collect payloads failed (%s), retrying', len(payloads), e.orig)
+            time.sleep(INGEST_RETRY_DELAY * 2 ** attempt)
+        except Exception:
+            db.session.rollback()
+            raise
+
+class Metrics:
+    """Process-wide counters and histograms, rendered in the Prometheus text format by /metrics.
+
+    With a directory, every process writes its own file there and render() merges all of them.
+    """
+
+    def __init__(self, buckets, directory=None):
+        self.buckets = buckets
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.kinds = {}
+        self.help = {}
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.flusher = None
+
+    def describe(self, name, kind, text):
+        self.kinds[name] = kind
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.start()
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.start()
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram[1] += seconds
+
+    def gauge(self, name, text, read):
+        self.describe(name, 'gauge', text)
+        self.gauges[name] = read
+
+    def start(self):
+        # Started lazily, so each forked server worker gets its own thread
+        if self.directory and (self.flusher is None or not self.flusher.is_alive()):
+            with self.lock:
+                if self.flusher is None or not self.flusher.is_alive():
+                    self.flusher = threading.Thread(target=self.run, name='mouseflow-metrics', daemon=True)
+                    self.flusher.start()
+
+    def run(self):
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except OSError:
+                app.logger.exception('Failed to write metrics to %s', self.directory)
+
+    def stop(self):
+        if self.flusher is not None:
+            self.flush()
+
+    def collect(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: [list(counts), total] for key, (counts, total) in self.histograms.items()}
+        gauges = {}
+        for name, read in self.gauges.items():
+            try:
+                gauges[(name, ())] = read()
+            except Exception:
+                app.logger.exception('Failed to read gauge %s', name)
+        return counters, histograms, gauges
+
+    def flush(self):
+        counters, histograms, gauges = self.collect()
+        data = {
+            'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+            'histograms': [[name, labels, counts, total] for (name, labels), (counts, total) in histograms.items()],
+            'gauges': [[name, labels, value] for (name, labels), value in gauges.items()]
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'metrics-{os.getpid()}.json')
+        with open(path + '.partial', 'w') as f:
+            json.dump(data, f)
+        os.replace(path + '.partial', path)
+        return counters, histograms, gauges
+
+    def merged(self):
+        # Counters and histograms of exited workers keep counting, so totals never go backwards
+        # when gunicorn replaces one; gauges only come from processes that are still running
+        counters, histograms, gauges = self.flush()
+        for filename in os.listdir(self.directory):
+            match = re.fullmatch(r'metrics-(\d+)\.json', filename)
+            if match is None or int(match.group(1)) == os.getpid():
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, labels, value in data['counters']:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, counts, total in data['histograms']:
+                histogram = histograms.setdefault((name, tuple(map(tuple, labels))),
+                                                  [[0] * (len(self.buckets) + 1), 0.0])
+                histogram[0] = [a + b for a, b in zip(histogram[0], counts)]
+                histogram[1] += total
+            if process_alive(int(match.group(1))):
+                for name, labels, value in data['gauges']:
+                    key = (name, tuple(map(tuple, labels)))
+                    gauges[key] = gauges.get(key, 0) + value
+        return counters, histograms, gauges
+
+    def render(self):
+        counters, histograms, gauges = self.merged() if self.directory else self.collect()
+        samples = [(name, labels, value) for (name, labels), value in counters.items()]
+        for (name, labels), (counts, total) in histograms.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                samples.append((name + '_bucket', labels + (('le', str(bound)),), cumulative))
+            samples.append((name + '_sum', labels, total))
+            samples.append((name + '_count', labels, cumulative))
+        samples.extend((name, labels, value) for (name, labels), value in gauges.items())
+        lines = []
+        described = set()
+        # Every sample of a family has to be contiguous; sorting is stable, so buckets stay in order
+        families = [(name if name in self.kinds else re.sub(r'_(bucket|sum|count)$', '', name), name, labels, value)
+                    for name, labels, value in samples]
+        for family, name, labels, value in sorted(families, key=lambda s: s[:2]):
+            if family not in described:
+                described.add(family)
+                lines.append(f'# HELP {family} {self.help.get(family, family)}')
+                lines.append(f'# TYPE {family} {self.kinds.get(family, "untyped")}')
+            label_text = ','.join(f'{key}="{metric_label(value)}"' for key, value in labels)
+            value = value if isinstance(value, int) else repr(float(value))
+            lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def metric_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+metrics = Metrics(METRIC_BUCKETS, METRICS_DIR)
+atexit.register(metrics.stop)
+metrics.describe('mouseflow_http_request_seconds', 'histogram', 'Time to build each HTTP response.')
+metrics.describe('mouseflow_ingest_parse_seconds', 'histogram', 'Time to decode and validate a /collect body.')
+metrics.describe('mouseflow_ingest_events_total', 'counter', 'Events accepted by /collect.')
+metrics.describe('mouseflow_ingest_write_seconds', 'histogram', 'Time to write one batch of /collect payloads.')
+metrics.describe('mouseflow_ingest_written_events_total', 'counter', 'Events committed to the database.')
+metrics.describe('mouseflow_ingest_write_failures_total', 'counter', 'Payloads lost to failed batch writes.')
+metrics.describe('mouseflow_ingest_write_retries_total', 'counter', 'Batch writes retried after a transient database error.')
+metrics.describe('mouseflow_render_seconds', 'histogram', 'Wall time of each finished render.')
+metrics.describe('mouseflow_render_stage_seconds', 'histogram', 'Time per call of each render stage.')
+metrics.describe('mouseflow_render_frames_total', 'counter', 'Video frames rendered.')
+metrics.describe('mouseflow_renders_total', 'counter', 'Finished render jobs by outcome.')
+
+class StageTimer:
+    """Collects the stage timings of one render and feeds them to the process-wide histograms."""
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.samples = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        self.samples.setdefault(name, []).append(seconds)
+        metrics.observe('mouseflow_render_stage_seconds', seconds, mode=self.mode, stage=name)
+
+    def summary(self):
+        result = {}
+        for name, samples in self.samples.items():
+            ms = np.array(samples) * 1000
+            p50, p99 = np.percentile(ms, [50, 99])
+            result[name] = {
+                'count': len(ms),
+                'total_ms': round(float(ms.sum()), 1),
+                'mean_ms': round(float(ms.mean()), 3),
+                'p50_ms': round(float(p50), 3),
+                'p99_ms': round(float(p99), 3),
+                'max_ms': round(float(ms.max()), 3),
+            }
+        return result
+
+class IngestWriter:
+    def __init__(self, flush_interval, flush_events, max_queue):
+        self.flush_interval = flush_interval
+        self.flush_events = flush_events
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.stopping = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, payload):
+        self.start()
+        try:
+            self.queue.put_nowait(payload)
+        except queue.Full:
+            return False
+        return True
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.stopping.clear()
+                self.thread = threading.Thread(target=self.run, name='mouseflow-ingest', daemon=True)
+                self.thread.start()
+
+    def flush(self):
+        self.queue.join()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.thread = None
+
+    def run(self):
+        while not (self.stopping.is_set() and self.queue.empty()):
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            event_count = len(batch[0]['rows'])
+            deadline = time.monotonic() + self.flush_interval
+            while event_count < self.flush_events:
+                try:
+                    payload = self.queue.get(timeout=max(deadline - time.monotonic(), 0.001))
+                except queue.Empty:
+                    break
+                batch.append(payload)
+                event_count += len(payload['rows'])
+            self.write(batch)
+
+    def write(self, batch):
+        try:
+            with app.app_context():
+                start = time.perf_counter()
+                written = False
+                if len(batch) > 1:
+                    try:
+                        write_payloads_retrying(batch)
+                        written = True
+                    except Exception:
+                        app.logger.exception('Failed to write %d queued /collect payloads together, '
+                                             'writing them one at a time', len(batch))
+                # Every payload was already answered with 202, so one bad payload must not cost the rest
+                written = batch if written else [p for p in batch if self.write_one(p)]
+                metrics.inc('mouseflow_ingest_written_events_total', sum(len(p['rows']) for p in written))
+                metrics.observe('mouseflow_ingest_write_seconds', time.perf_counter() - start)
+        finally:
+            for _ in batch:
+                self.queue.task_done()
+
+    def write_one(self, payload):
+        try:
+            write_payloads_retrying([payload])
+            return True
+        except Exception:
+            metrics.inc('mouseflow_ingest_write_failures_total')
+            app.logger.exception('Dropped a queued /collect payload of %d events from %s',
+                                 len(payload['rows']), payload['ip_address'])
+            return False
+
+ingest_writer = IngestWriter(INGEST_FLUSH_INTERVAL, INGEST_FLUSH_EVENTS, INGEST_QUEUE_SIZE)
+atexit.register(ingest_writer.stop)
 
 # ROUTES
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        metrics.observe('mouseflow_http_request_seconds', time.perf_counter() - start,
+                        endpoint=request.endpoint or 'unmatched', method=request.method, status=response.status_code)
+    return response
+
+@app.route('/metrics')
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/collect', methods=['POST'])
 def collect():
-    data = request.get_json()
     user_agent = request.headers.get('User-Agent', '')
     if 'MOUSE_FLOW_VIDEO_GENERATION' in user_agent:
         return jsonify({'status': 'ignored', 'reason': 'video_generation'})
-    url = data.get('url') or request.headers.get('Referer') or request.args.get('url') or 'unknown'
-    session = Session(
-        ip_address=request.remote_addr, 
-        user_agent=request.headers.get('User-Agent'),
-        url=url
-    )
-    db.session.add(session)
-    db.session.flush()
-    for evt in data.get('events', []):
-        event = Event(
-            session_id=session.id,
-            event_type=evt['type'],
-            timestamp=datetime.datetime.fromtimestamp(evt['timestamp'] / 1000.0, tz=PKT),
-            x=evt.get('x'),
-            y=evt.get('y'),
-            additional_data=evt.get('data')
-        )
-        db.session.add(event)
-    db.session.commit()
-    return jsonify({'status': 'success'})
+    parse_start = time.perf_counter()
+    try:
+        data = read_collect_body()
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    if not isinstance(data, dict):
+        return jsonify({'status': 'error', 'message': 'Expected a JSON object'}), 400
+    try:
+        if data.get('v') == COMPACT_FORMAT_VERSION:
+            rows = build_event_rows(expand_compact_events(data))
+        else:
+            rows = build_event_rows(data.get('events', []))
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    token = data.get('session_token') or None
+    if token is not None and (not isinstance(token, str) or len(token) > SESSION_TOKEN_MAX_LENGTH):
+        return jsonify({'status': 'error', 'message': 'Invalid session_token'}), 400
+    metrics.observe('mouseflow_ingest_parse_seconds', time.perf_counter() - parse_start)
+    payload = {
+        'token': token,
+        'ip_address': request.remote_addr,
+        # Cut to the column sizes, which PostgreSQL enforces and SQLite does not
+        'user_agent': (request.headers.get('User-Agent') or '')[:255] or None,
+        'url': str(data.get('url') or request.headers.get('Referer') or request.args.get('url') or 'unknown')[:500],
+        'received_at': datetime.datetime.now(PKT),
+        'rows': rows
+    }
+    if not INGEST_ASYNC:
+        start = time.perf_counter()
+        write_payloads_retrying([payload])
+        metrics.observe('mouseflow_ingest_write_seconds', time.perf_counter() - start)
+        metrics.inc('mouseflow_ingest_events_total', len(rows))
+        metrics.inc('mouseflow_ingest_written_events_total', len(rows))
+        return jsonify({'status': 'success'})
+    if not ingest_writer.submit(payload):
+        response = jsonify({'status': 'error', 'message': 'Ingest queue is full, retry later'})
+        response.headers['Retry-After'] = '1'
+        return response, 429
+    metrics.inc('mouseflow_ingest_events_total', len(rows))
+    return jsonify({'status': 'queued'}), 202
+
+def parse_date_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        value = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        abort(400, f'Invalid {name} date: {value}')
+    # Timestamps are stored as naive Karachi wall-clock times
+    if value.tzinfo:
+        value = value.astimezone(PKT).replace(tzinfo=None)
+    return value
+
+def session_event_stats(session_ids):
+    if not session_ids:
+        return {}
+    rows = db.session.query(
+        Event.session_id,
+        func.count(Event.id),
+        func.sum(case((Event.event_type == 'click', 1), else_=0)),
+        func.sum(case((Event.event_type == 'mousemove', 1), else_=0)),
+        func.max(case((Event.event_type == 'scroll', Event.y), else_=None))
+    ).filter(Event.session_id.in_(session_ids)).group_by(Event.session_id)
+    stats = {session_id: {
+        'total': total or 0,
+        'clicks': clicks or 0,
+        'moves': moves or 0,
+        'max_scroll': float(max_scroll) if max_scroll is not None else 0
+    } for session_id, total, clicks, moves, max_scroll in rows}
+    packed = db.session.query(MoveChunk.session_id, func.sum(MoveChunk.count)).filter(
+        MoveChunk.session_id.in_(session_ids)).group_by(MoveChunk.session_id)
+    for session_id, count in packed:
+        session_stats = stats.setdefault(session_id, {'total': 0, 'clicks': 0, 'moves': 0, 'max_scroll': 0})
+        session_stats['total'] += count or 0
+        session_stats['moves'] += count or 0
+    return stats
 
 @app.route('/sessions', methods=['GET'])
 def list_sessions():
-    sessions = Session.query.order_by(Session.timestamp.desc()).all()
+    per_page = min(max(request.args.get('per_page', SESSIONS_PER_PAGE, type=int), 1), SESSIONS_MAX_PER_PAGE)
+    url_filter = request.args.get('url', '').strip()
+    ip_filter = request.args.get('ip', '').strip()
+    since = parse_date_arg('since')
+    until = parse_date_arg('until')
+    query = Session.query
+    if url_filter:
+        query = query.filter(Session.url.contains(url_filter))
+    if ip_filter:
+        query = query.filter(Session.ip_address == ip_filter)
+    if since:
+        query = query.filter(Session.timestamp >= since)
+    if until:
+        query = query.filter(Session.timestamp < until)
+    before = request.args.get('before', type=int)
+    if before:
+        cursor = db.session.get(Session, before)
+        if cursor is not None:
+            query = query.filter(or_(
+                Session.timestamp < cursor.timestamp,
+                and_(Session.timestamp == cursor.timestamp, Session.id < cursor.id)
+            ))
+    sessions = query.order_by(Session.timestamp.desc(), Session.id.desc()).limit(per_page + 1).all()
+    next_before = sessions[per_page - 1].id if len(sessions) > per_page else None
+    sessions = sessions[:per_page]
+    stats = session_event_stats([session.id for session in sessions])
+    videos = {v.session_id: v for v in Video.query.filter(Video.session_id.in_([session.id for session in sessions]))}
     sessions_data = []
     for session in sessions:
-        click_count = sum(1 for e in session.events if e.event_type == 'click')
-        move_count = sum(1 for e in session.events if e.event_type == 'mousemove')
-        total_events = len(session.events)
+        session_stats = stats.get(session.id, {'total': 0, 'clicks': 0, 'moves': 0, 'max_scroll': 0})
+        click_count = session_stats['clicks']
+        move_count = session_stats['moves']
+        total_events = session_stats['total']
         move_percentage = round((move_count / total_events * 100) if total_events > 0 else 0, 1)
-        scroll_percents = []
-        for e in session.events:
-            if e.event_type == 'scroll':
-                try:
-                    percent = float(e.y) if e.y is not None else 0
-                    scroll_percents.append(percent)
-                except Exception:
-                    pass
-        max_scroll_percent = min(max(scroll_percents) if scroll_percents else 0, 100)
-        video_path = None
-        video_file_mp4 = os.path.join('static', 'videos', f'session_{session.id}.mp4')
-        video_file_simple_mp4 = os.path.join('static', 'videos', f'session_{session.id}_simple.mp4')
-        video_file_real_browser_mp4 = os.path.join('static', 'videos', f'session_{session.id}_real_browser.mp4')
-        if os.path.exists(video_file_mp4):
-            video_path = f'/static/videos/session_{session.id}.mp4'
-        elif os.path.exists(video_file_simple_mp4):
-            video_path = f'/static/videos/session_{session.id}_simple.mp4'
-        elif os.path.exists(video_file_real_browser_mp4):
-            video_path = f'/static/videos/session_{session.id}_real_browser.mp4'
+        max_scroll_percent = min(session_stats['max_scroll'], 100)
+        video = videos.get(session.id)
+        video_path = video.url if video else None
         try:
             session_url = session.url if hasattr(session, 'url') else 'unknown'
         except:
@@ -108,100 +1139,617 @@ def list_sessions():
             'clicks': click_count,
             'move_percentage': move_percentage,
             'scrolls': max_scroll_percent,
-            'video_path': video_path
+            'video_path': video_path,
+            'video_url': url_for('serve_video', session_id=session.id, v=video.version) if video else None,
+            # Videos rendered before thumbnails existed have none; the page copes with the 404
+            'poster_url': url_for('serve_thumbnail', session_id=session.id, kind='poster', v=video.version)
+                          if video else None,
+            'sprite_url': url_for('serve_thumbnail', session_id=session.id, kind='sprite', v=video.version)
+                          if video else None
         })
-    return render_template('dashboard.html', sessions=sessions_data)
+    filters = {k: v for k, v in {
+        'url': url_filter,
+        'ip': ip_filter,
+        'since': request.args.get('since', ''),
+        'until': request.args.get('until', ''),
+        'per_page': per_page if per_page != SESSIONS_PER_PAGE else None
+    }.items() if v}
+    return render_template('dashboard.html', sessions=sessions_data, filters=filters,
+                           next_before=next_before, is_first_page=not before, sprite_frames=SPRITE_FRAMES)
+
+def encode_session_events(events):
+    batch = []
+    for event_type, timestamp, x, y, data in events:
+        batch.append(json.dumps({
+            'type': event_type,
+            'timestamp': timestamp.isoformat(),
+            'x': x,
+            'y': y,
+            'data': get_scroll_percentage(data) if event_type == 'scroll' else data
+        }))
+        if len(batch) == SESSION_STREAM_BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 @app.route('/session/<int:session_id>', methods=['GET'])
 def get_session_data(session_id):
     session = Session.query.get_or_404(session_id)
-    return jsonify({
+    since = parse_date_arg('since')
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit < 0:
+        abort(400, 'limit must not be negative')
+    types = [t for t in request.args.get('types', '').split(',') if t] or None
+    ndjson = (request.args.get('format') == 'ndjson'
+              or request.accept_mimetypes.best == 'application/x-ndjson')
+    header = {
         'session_id': session.id,
         'ip_address': session.ip_address,
         'timestamp': session.timestamp.isoformat(),
-        'user_agent': session.user_agent,
-        'events': [{
-            'type': e.event_type,
-            'timestamp': e.timestamp.isoformat(),
-            'x': e.x,
-            'y': e.y,
-            'data': get_scroll_percentage(e) if e.event_type == 'scroll' else e.additional_data
-        } for e in session.events]
-    })
+        'user_agent': session.user_agent
+    }
+    batches = encode_session_events(stream_session_events(session.id, since, types, limit))
+
+    # NDJSON is the header object followed by one event per line; plain JSON keeps the
+    # old single-document shape but is still written out as events are read
+    def generate():
+        if ndjson:
+            yield json.dumps(header) + '\n'
+            for batch in batches:
+                yield '\n'.join(batch) + '\n'
+            return
+        yield json.dumps(header)[:-1] + ', "events": ['
+        separator = ''
+        for batch in batches:
+            yield separator + ', '.join(batch)
+            separator = ', '
+        yield ']}'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson' if ndjson else 'application/json')
 
 @app.route('/delete_session/<int:session_id>', methods=['DELETE'])
 def delete_session(session_id):
     session = Session.query.get_or_404(session_id)
+    video_path = session.video.path if session.video else None
     db.session.delete(session)
     db.session.commit()
-    for ext in ['.mp4']:
-        video_path = os.path.join('static', 'videos', f'session_{session_id}{ext}')
-        if os.path.exists(video_path):
-            try:
-                os.remove(video_path)
-            except OSError:
-                pass
-        simple_video_path = os.path.join('static', 'videos', f'session_{session_id}_simple{ext}')
-        if os.path.exists(simple_video_path):
-            try:
-                os.remove(simple_video_path)
-            except OSError:
-                pass
-        real_browser_video_path = os.path.join('static', 'videos', f'session_{session_id}_real_browser{ext}')
-        if os.path.exists(real_browser_video_path):
-            try:
-                os.remove(real_browser_video_path)
-            except OSError:
-                pass
+    if video_path:
+        remove_file(video_path)
+    for path in [page_cache_path(session_id)] + thumbnail_paths(session_id):
+        remove_file(path)
     return jsonify({'status': 'deleted'}), 200
 
+def send_media(path, mimetype, video, kind):
+    """Send a rendered file with a strong ETag and Last-Modified, answering 304s and byte ranges.
+
+    With MOUSEFLOW_SENDFILE set, only revalidation is decided here and the proxy sends the bytes and ranges.
+    """
+    etag = f'{video.session_id}-{kind}-{video.version}'
+    response = Response(mimetype=mimetype)
+    response.set_etag(etag)
+    response.last_modified = video.last_modified
+    # Revalidation only needs the registry row, so a 304 never touches the disk or the proxy
+    response.make_conditional(request)
+    if response.status_code != 304:
+        if MEDIA_SENDFILE == 'x-accel-redirect':
+            response.headers['X-Accel-Redirect'] = (MEDIA_ACCEL_PREFIX
+                                                    + os.path.relpath(path, VIDEO_DIR).replace(os.sep, '/'))
+        elif MEDIA_SENDFILE == 'x-sendfile':
+            response.headers['X-Sendfile'] = os.path.abspath(path)
+        elif not os.path.isfile(path):
+            return jsonify({'error': 'File not found'}), 404
+        else:
+            # send_file resolves relative paths against the app package rather than the working directory
+            response = send_file(os.path.abspath(path), mimetype=mimetype, etag=etag,
+                                 last_modified=video.last_modified, conditional=True)
+    response.headers['Accept-Ranges'] = 'bytes'
+    if request.args.get('v') == video.version:
+        response.headers['Cache-Control'] = f'public, max-age={MEDIA_MAX_AGE}, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 @app.route('/video/<int:session_id>')
 def serve_video(session_id):
-    video_dir = os.path.join('static', 'videos')
-    for ext in ['.mp4']:
-        video_path = os.path.join(video_dir, f'session_{session_id}{ext}')
-        if os.path.exists(video_path):
-            response = send_from_directory(video_dir, f'session_{session_id}{ext}')
-            response.headers['Content-Type'] = 'video/mp4'
-            response.headers['Accept-Ranges'] = 'bytes'
-            response.headers['Cache-Control'] = 'public, max-age=3600'
-            return response
-    for ext in ['.mp4']:
-        video_path = os.path.join(video_dir, f'session_{session_id}_simple{ext}')
-        if os.path.exists(video_path):
-            response = send_from_directory(video_dir, f'session_{session_id}_simple{ext}')
-            response.headers['Content-Type'] = 'video/mp4'
-            response.headers['Accept-Ranges'] = 'bytes'
-            response.headers['Cache-Control'] = 'public, max-age=3600'
-            return response
-    for ext in ['.mp4']:
-        video_path = os.path.join(video_dir, f'session_{session_id}_real_browser{ext}')
-        if os.path.exists(video_path):
-            response = send_from_directory(video_dir, f'session_{session_id}_real_browser{ext}')
-            response.headers['Content-Type'] = 'video/mp4'
-            response.headers['Accept-Ranges'] = 'bytes'
-            response.headers['Cache-Control'] = 'public, max-age=3600'
-            return response
-    return jsonify({'error': 'Video not found'}), 404
+    video = Video.query.filter_by(session_id=session_id).first()
+    if video is None:
+        return jsonify({'error': 'Video not found'}), 404
+    return send_media(video.path, 'video/mp4', video, 'video')
+
+@app.route('/video/<int:session_id>/<any(poster, sprite):kind>.jpg')
+def serve_thumbnail(session_id, kind):
+    video = Video.query.filter_by(session_id=session_id).first()
+    if video is None:
+        return jsonify({'error': 'Video not found'}), 404
+    path = poster_path(session_id) if kind == 'poster' else sprite_path(session_id)
+    return send_media(path, 'image/jpeg', video, kind)
+
+def heatmap_args():
+    url = request.args.get('url')
+    if not url:
+        abort(400, 'url is required')
+    event_type = request.args.get('type', 'mousemove')
+    if event_type not in HEATMAP_EVENT_TYPES:
+        abort(400, f'type must be one of {", ".join(HEATMAP_EVENT_TYPES)}')
+    return url, event_type
+
+@app.route('/heatmap')
+def get_heatmap():
+    url, event_type = heatmap_args()
+    heatmap = Heatmap.query.filter_by(url=url, event_type=event_type).first()
+    grid = heatmap.grid if heatmap else np.zeros(HEATMAP_SHAPE, dtype=np.uint32)
+    return jsonify({
+        'url': url,
+        'type': event_type,
+        'total': heatmap.total if heatmap else 0,
+        'updated_at': heatmap.updated_at.isoformat() if heatmap else None,
+        'cell_size': HEATMAP_CELL,
+        'width': HEATMAP_WIDTH,
+        'height': HEATMAP_HEIGHT,
+        'max': int(grid.max()),
+        'counts': grid.tolist()
+    })
+
+def render_heatmap(grid, width, height):
+    # Log scale so a few hot spots don't wash out everything else
+    intensity = cv2.GaussianBlur(np.log1p(grid.astype(np.float32)), (0, 0), sigmaX=1.0)
+    intensity = cv2.resize(intensity, (width, height), interpolation=cv2.INTER_LINEAR)
+    if intensity.max() > 0:
+        intensity /= intensity.max()
+    overlay = cv2.cvtColor(cv2.applyColorMap((intensity * 255).astype(np.uint8), cv2.COLORMAP_JET), cv2.COLOR_BGR2BGRA)
+    # Cold cells fade out so the overlay can sit on top of the page
+    overlay[:, :, 3] = (intensity * 200).astype(np.uint8)
+    return overlay
+
+@app.route('/heatmap.png')
+def get_heatmap_png():
+    url, event_type = heatmap_args()
+    width = min(request.args.get('width', HEATMAP_PNG_WIDTH, type=int), HEATMAP_WIDTH)
+    if width < HEATMAP_SHAPE[1]:
+        abort(400, f'width must be at least {HEATMAP_SHAPE[1]}')
+    height = width * HEATMAP_HEIGHT // HEATMAP_WIDTH
+    heatmap = Heatmap.query.filter_by(url=url, event_type=event_type).first()
+    # The grid only changes when events are added, so revalidation can skip the render
+    etag = f'{heatmap.id}-{heatmap.total}-{width}' if heatmap else f'empty-{width}'
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        grid = heatmap.grid if heatmap else np.zeros(HEATMAP_SHAPE, dtype=np.uint32)
+        ok, png = cv2.imencode('.png', render_heatmap(grid, width, height), [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        if not ok:
+            return jsonify({'status': 'error', 'message': 'Failed to encode heatmap'}), 500
+        response = Response(png.tobytes(), mimetype='image/png')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route('/clear_sessions', methods=['DELETE'])
 def clear_sessions():
+    db.session.query(Heatmap).delete()
+    db.session.query(Video).delete()
+    db.session.query(MoveChunk).delete()
     db.session.query(Event).delete()
+    db.session.query(DownsampledSession).delete()
     db.session.query(Session).delete()
     db.session.commit()
-    video_dir = os.path.join('static', 'videos')
-    for f in os.listdir(video_dir):
+    for f in os.listdir(VIDEO_DIR):
         if f.endswith(('.mp4', '.avi')):
-            os.remove(os.path.join(video_dir, f))
+            os.remove(os.path.join(VIDEO_DIR, f))
+    shutil.rmtree(PAGE_CACHE_DIR, ignore_errors=True)
+    shutil.rmtree(THUMBNAIL_DIR, ignore_errors=True)
     return jsonify({'status': 'cleared'}), 200
 
+def sqlite_database_path():
+    url = db.engine.url
+    if url.get_backend_name() == 'sqlite' and url.database and url.database != ':memory:':
+        return url.database
+    return None
+
+def sqlite_file_size(db_path):
+    with db.engine.connect() as connection:
+        connection.exec_driver_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+    return os.path.getsize(db_path)
+
+def time_session_load(session_id):
+    start = time.perf_counter()
+    events = load_session_events(session_id)
+    len(events)
+    return time.perf_counter() - start
+
+@app.cli.command('pack-moves')
+@click.option('--vacuum', is_flag=True, help='VACUUM afterwards so the file actually shrinks.')
+def pack_moves_command(vacuum):
+    """Convert mousemove Event rows into packed MoveChunk blobs."""
+    db_path = sqlite_database_path()
+    size_before = sqlite_file_size(db_path) if db_path else None
+    counts = db.session.query(Event.session_id, func.count(Event.id)).filter(
+        Event.event_type == 'mousemove').group_by(Event.session_id).all()
+    if not counts:
+        print('No mousemove rows to pack.')
+        return
+    largest = max(counts, key=lambda c: c[1])[0]
+    load_before = time_session_load(largest)
+    db.session.rollback()
+    packed = 0
+    for session_id, _ in counts:
+        moves = db.session.query(Event.timestamp, Event.x, Event.y).filter(
+            Event.session_id == session_id, Event.event_type == 'mousemove').order_by(Event.timestamp, Event.id).all()
+        for start_time, count, data in pack_moves(moves):
+            db.session.add(MoveChunk(session_id=session_id, start_time=start_time, count=count, data=data))
+        db.session.query(Event).filter(Event.session_id == session_id, Event.event_type == 'mousemove').delete(
+            synchronize_session=False)
+        db.session.commit()
+        packed += len(moves)
+    load_after = time_session_load(largest)
+    db.session.rollback()
+    if vacuum and db_path:
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.exec_driver_sql('VACUUM')
+    print(f'Packed {packed} mousemove rows from {len(counts)} sessions.')
+    print(f'Loading session {largest}: {load_before * 1000:.1f} ms before, {load_after * 1000:.1f} ms after.')
+    if db_path:
+        size_after = sqlite_file_size(db_path)
+        print(f'Database file: {size_before / 2**20:.1f} MiB before, {size_after / 2**20:.1f} MiB after'
+              + ('' if vacuum else ' (run with --vacuum to reclaim free pages)') + '.')
+
+def probe_video(path):
+    capture = cv2.VideoCapture(path)
+    try:
+        if not capture.isOpened():
+            return None, None
+        fourcc = int(capture.get(cv2.CAP_PROP_FOURCC))
+        codec = ''.join(chr((fourcc >> 8 * i) & 0xFF) for i in range(4)).strip('\x00 ') or None
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        frame_count = capture.get(cv2.CAP_PROP_FRAME_COUNT)
+        duration = frame_count / fps if fps and frame_count > 0 else None
+        return codec, duration
+    finally:
+        capture.release()
+
+VIDEO_FILENAME_RE = re.compile(r'^session_(\d+)(' + '|'.join(re.escape(v) for v in VIDEO_VARIANTS if v) + r')?\.mp4$')
+
+@app.cli.command('rebuild-heatmaps')
+def rebuild_heatmaps():
+    """Recompute every per-URL heatmap from the stored events."""
+    start = time.perf_counter()
+    db.session.query(Heatmap).delete()
+    counts = {}
+    pending = {}
+
+    def add(key, x, y):
+        grid, total = counts.get(key, (0, 0))
+        counts[key] = (grid + bin_points(x, y), total + len(x))
+
+    rows = db.session.execute(
+        select(Session.url, Event.event_type, Event.x, Event.y).join(Event).where(
+            Session.url.isnot(None), Event.event_type.in_(HEATMAP_EVENT_TYPES),
+            Event.x.isnot(None), Event.y.isnot(None)).execution_options(yield_per=SESSION_STREAM_BATCH))
+    for url, event_type, x, y in rows:
+        coords = pending.setdefault((url, event_type), [])
+        coords.append((x, y))
+        if len(coords) == MOVE_CHUNK_MAX_POINTS:
+            add((url, event_type), *np.array(pending.pop((url, event_type))).T)
+    for key, coords in pending.items():
+        add(key, *np.array(coords).T)
+    chunks = db.session.execute(
+        select(Session.url, MoveChunk).join(MoveChunk).where(Session.url.isnot(None)).execution_options(yield_per=8))
+    for url, chunk in chunks:
+        _, x, y = unpack_moves(chunk)
+        add((url, 'mousemove'), x, y)
+    add_to_heatmaps(counts)
+    db.session.commit()
+    total = sum(total for _, total in counts.values())
+    print(f'Rebuilt {len(counts)} heatmaps from {total} events in {time.perf_counter() - start:.1f}s.')
+
+@app.cli.command('reconcile-videos')
+def reconcile_videos():
+    """Rebuild the video registry from the files in static/videos."""
+    found = {}
+    for filename in os.listdir(VIDEO_DIR) if os.path.isdir(VIDEO_DIR) else []:
+        match = VIDEO_FILENAME_RE.match(filename)
+        if not match:
+            continue
+        session_id = int(match.group(1))
+        rank = VIDEO_VARIANTS.index(match.group(2) or '')
+        if session_id not in found or rank < found[session_id][0]:
+            found[session_id] = (rank, filename)
+    existing = {session_id for (session_id,) in db.session.query(Session.id).filter(Session.id.in_(found))}
+    removed = 0
+    for video in Video.query.all():
+        if video.session_id not in found or found[video.session_id][1] != video.filename:
+            db.session.delete(video)
+            removed += 1
+    db.session.commit()
+    registered = 0
+    for session_id, (_, filename) in sorted(found.items()):
+        if session_id not in existing:
+            continue
+        path = os.path.join(VIDEO_DIR, filename)
+        codec, duration = probe_video(path)
+        generated_at = datetime.datetime.fromtimestamp(os.path.getmtime(path), tz=PKT)
+        register_video(session_id, filename, codec, duration, generated_at)
+        registered += 1
+    print(f'Registered {registered} videos, removed {removed} stale entries, '
+          f'skipped {len(found) - registered} files without a session.')
+
+@app.cli.command('build-thumbnails')
+@click.option('--force', is_flag=True, help='Rebuild thumbnails that already exist.')
+def build_thumbnails(force):
+    """Write posters and sprites for videos rendered before they existed."""
+    built = failed = 0
+    for video in Video.query.order_by(Video.session_id):
+        if not force and os.path.exists(poster_path(video.session_id)):
+            continue
+        sampler = FrameSampler(SPRITE_FRAMES, POSTER_WIDTH)
+        capture = cv2.VideoCapture(video.path)
+        # grab() skips decoding into BGR for the frames the sampler does not keep
+        while capture.grab():
+            sampler.add(capture.retrieve()[1] if sampler.wants() else None)
+        capture.release()
+        if write_thumbnails(video.session_id, sampler):
+            built += 1
+        else:
+            failed += 1
+            print(f'Session {video.session_id}: could not read {video.path}')
+    print(f'Built thumbnails for {built} videos, {failed} unreadable.')
+
+def retention_cutoff(days):
+    # A session idle for less than SESSION_IDLE_TIMEOUT can still be extended, so it is never old enough
+    age = max(datetime.timedelta(days=days), SESSION_IDLE_TIMEOUT)
+    return (datetime.datetime.now(PKT) - age).replace(tzinfo=None)
+
+def session_last_activity():
+    return func.coalesce(Session.last_seen, Session.timestamp)
+
+def downsample_session_moves(session_id, interval_ms):
+    """Keep the first mousemove in every interval_ms window of the session; returns (before, after) counts."""
+    before = after = 0
+    chunks = MoveChunk.query.filter_by(session_id=session_id).order_by(MoveChunk.start_time, MoveChunk.id).all()
+    if chunks:
+        base_time = chunks[0].start_time
+        points = []
+        for chunk in chunks:
+            t_ms, x, y = unpack_moves(chunk)
+            points.append(np.stack([t_ms + round((chunk.start_time - base_time).total_seconds() * 1000), x, y]))
+        points = np.concatenate(points, axis=1)
+        points = points[:, np.argsort(points[0], kind='stable')]
+        _, keep = np.unique(points[0] // interval_ms, return_index=True)
+        before += points.shape[1]
+        after += len(keep)
+        if len(keep) < points.shape[1]:
+            points = points[:, keep]
+            MoveChunk.query.filter_by(session_id=session_id).delete(synchronize_session=False)
+            for start_ms, part in split_move_columns(points):
+                db.session.add(MoveChunk(session_id=session_id, count=part.shape[1], data=pack_move_columns(part),
+                                         start_time=base_time + datetime.timedelta(milliseconds=start_ms)))
+    rows = db.session.query(Event.id, Event.timestamp).filter(
+        Event.session_id == session_id, Event.event_type == 'mousemove').order_by(Event.timestamp, Event.id).all()
+    if rows:
+        base_time = rows[0][1]
+        t_ms = np.array([(timestamp - base_time).total_seconds() * 1000 for _, timestamp in rows])
+        _, keep = np.unique(np.floor(t_ms / interval_ms), return_index=True)
+        drop = np.ones(len(rows), dtype=bool)
+        drop[keep] = False
+        ids = [rows[i][0] for i in np.flatnonzero(drop)]
+        for i in range(0, len(ids), SESSION_STREAM_BATCH):
+            Event.query.filter(Event.id.in_(ids[i:i + SESSION_STREAM_BATCH])).delete(synchronize_session=False)
+        before += len(rows)
+        after += len(keep)
+    db.session.add(DownsampledSession(session_id=session_id, interval_ms=interval_ms))
+    return before, after
+
+def archive_path(day):
+    return os.path.join(ARCHIVE_DIR, f'sessions-{day.isoformat()}.ndjson.gz')
+
+def archive_record(session):
+    # One line per session; events keep their raw additional_data so import-archive restores them exactly
+    return {
+        'session': {
+            'id': session.id,
+            'ip_address': session.ip_address,
+            'user_agent': session.user_agent,
+            'url': session.url,
+            'token': session.token,
+            'timestamp': session.timestamp.isoformat() if session.timestamp else None,
+            'last_seen': session.last_seen.isoformat() if session.last_seen else None,
+        },
+        'events': [[event_type, timestamp.isoformat(), x, y, data]
+                   for event_type, timestamp, x, y, data in stream_session_events(session.id)],
+    }
+
+def write_archive(sessions):
+    """Append sessions to their per-day archive files and fsync them; returns bytes written."""
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    by_day = {}
+    for session in sessions:
+        by_day.setdefault(session.timestamp.date(), []).append(session)
+    written = 0
+    for day, day_sessions in sorted(by_day.items()):
+        # Every append is a separate gzip member; gzip readers see the members as one stream
+        with open(archive_path(day), 'ab') as raw:
+            offset = raw.tell()
+            with gzip.GzipFile(fileobj=raw, mode='ab') as archive:
+                for session in day_sessions:
+                    archive.write(json.dumps(archive_record(session), separators=(',', ':')).encode() + b'\n')
+            raw.flush()
+            os.fsync(raw.fileno())
+            written += raw.tell() - offset
+    return written
+
+def purge_sessions(session_ids):
+    """Delete sessions with their events, videos and page caches; returns the number of files removed."""
+    paths = [os.path.join(VIDEO_DIR, filename) for (filename,) in
+             db.session.query(Video.filename).filter(Video.session_id.in_(session_ids))]
+    for session_id in session_ids:
+        paths += [page_cache_path(session_id)] + thumbnail_paths(session_id)
+    for model in (Video, MoveChunk, Event, DownsampledSession):
+        db.session.query(model).filter(model.session_id.in_(session_ids)).delete(synchronize_session=False)
+    db.session.query(Session).filter(Session.id.in_(session_ids)).delete(synchronize_session=False)
+    db.session.commit()
+    removed = 0
+    for path in paths:
+        if os.path.exists(path):
+            remove_file(path)
+            removed += 1
+    return removed
+
+def remove_orphaned_videos():
+    """Drop Video rows and files in static/videos whose session no longer exists."""
+    removed = 0
+    orphans = Video.query.filter(~Video.session_id.in_(select(Session.id))).all()
+    for video in orphans:
+        remove_file(video.path)
+        db.session.delete(video)
+        removed += 1
+    db.session.commit()
+    candidates = {}
+    for filename in os.listdir(VIDEO_DIR) if os.path.isdir(VIDEO_DIR) else []:
+        match = VIDEO_FILENAME_RE.match(filename)
+        if match:
+            candidates.setdefault(int(match.group(1)), []).append(os.path.join(VIDEO_DIR, filename))
+    for filename in os.listdir(PAGE_CACHE_DIR) if os.path.isdir(PAGE_CACHE_DIR) else []:
+        match = re.match(r'^session_(\d+)\.png$', filename)
+        if match:
+            candidates.setdefault(int(match.group(1)), []).append(os.path.join(PAGE_CACHE_DIR, filename))
+    for filename in os.listdir(THUMBNAIL_DIR) if os.path.isdir(THUMBNAIL_DIR) else []:
+        match = re.match(r'^session_(\d+)_(poster|sprite)\.jpg$', filename)
+        if match:
+            candidates.setdefault(int(match.group(1)), []).append(os.path.join(THUMBNAIL_DIR, filename))
+    ids = sorted(candidates)
+    for i in range(0, len(ids), SESSION_STREAM_BATCH):
+        batch = ids[i:i + SESSION_STREAM_BATCH]
+        existing = {session_id for (session_id,) in db.session.query(Session.id).filter(Session.id.in_(batch))}
+        for session_id in batch:
+            if session_id not in existing:
+                for path in candidates[session_id]:
+                    remove_file(path)
+                    removed += 1
+    return removed
+
+@app.cli.command('retention')
+@click.option('--downsample-days', type=float, default=RETENTION_DOWNSAMPLE_DAYS, show_default=True,
+              help='Downsample mousemoves in sessions older than this many days (0 to skip).')
+@click.option('--interval-ms', type=int, default=RETENTION_DOWNSAMPLE_MS, show_default=True,
+              help='Keep one mousemove per this many milliseconds when downsampling.')
+@click.option('--archive-days', type=float, default=RETENTION_ARCHIVE_DAYS, show_default=True,
+              help='Archive and delete sessions older than this many days (0 to skip).')
+@click.option('--batch', type=int, default=RETENTION_BATCH, show_default=True, help='Sessions per transaction.')
+@click.option('--dry-run', is_flag=True, help='Only count what would be downsampled and archived.')
+@click.option('--vacuum', is_flag=True, help='VACUUM afterwards so the file actually shrinks.')
+def retention(downsample_days, interval_ms, archive_days, batch, dry_run, vacuum):
+    """Archive old sessions, downsample old mousemoves and remove orphaned videos."""
+    if interval_ms <= 0 or batch <= 0:
+        raise click.BadParameter('--interval-ms and --batch must be positive')
+    db_path = sqlite_database_path()
+    size_before = sqlite_file_size(db_path) if db_path and not dry_run else None
+    start = time.perf_counter()
+    archive_cutoff = retention_cutoff(archive_days) if archive_days > 0 else None
+    downsample_cutoff = retention_cutoff(downsample_days) if downsample_days > 0 else None
+    # Sessions are picked by their last event rather than their start, since a visit keeps growing until it goes idle
+    if archive_cutoff:
+        query = Session.query.filter(session_last_activity() < archive_cutoff)
+        if dry_run:
+            print(f'Would archive {query.count()} sessions idle since before {archive_cutoff:%Y-%m-%d %H:%M}.')
+        else:
+            archived = written = files = 0
+            last_id = 0
+            while True:
+                sessions = query.filter(Session.id > last_id).order_by(Session.id).limit(batch).all()
+                if not sessions:
+                    break
+                last_id = sessions[-1].id
+                written += write_archive(sessions)
+                # A payload queued before the cutoff may have extended a session since it was archived;
+                # with ingest locked out, only sessions that are still idle are deleted
+                lock_for_ingest()
+                ids = [session_id for (session_id,) in db.session.query(Session.id).filter(
+                    Session.id.in_([session.id for session in sessions]), session_last_activity() < archive_cutoff)]
+                files += purge_sessions(ids)
+                archived += len(ids)
+            print(f'Archived {archived} sessions to {ARCHIVE_DIR} ({written / 2**20:.1f} MiB), '
+                  f'removed {files} video and page files.')
+    if downsample_cutoff:
+        query = db.session.query(Session.id).outerjoin(DownsampledSession).filter(
+            session_last_activity() < downsample_cutoff, DownsampledSession.session_id.is_(None))
+        if dry_run:
+            print(f'Would downsample {query.count()} sessions idle since before {downsample_cutoff:%Y-%m-%d %H:%M}.')
+        else:
+            sessions = before = after = 0
+            last_id = 0
+            while True:
+                ids = [session_id for (session_id,) in
+                       query.filter(Session.id > last_id).order_by(Session.id).limit(batch)]
+                if not ids:
+                    break
+                for session_id in ids:
+                    counts = downsample_session_moves(session_id, interval_ms)
+                    before += counts[0]
+                    after += counts[1]
+                db.session.commit()
+                sessions += len(ids)
+                last_id = ids[-1]
+            print(f'Downsampled {sessions} sessions to one mousemove per {interval_ms} ms: '
+                  f'{before} points down to {after}.')
+    if not archive_cutoff and not downsample_cutoff:
+        print('No retention policy set; pass --archive-days or --downsample-days.')
+    if dry_run:
+        return
+    print(f'Removed {remove_orphaned_videos()} orphaned video files in {time.perf_counter() - start:.1f}s.')
+    if vacuum and db_path:
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.exec_driver_sql('VACUUM')
+    if db_path:
+        size_after = sqlite_file_size(db_path)
+        print(f'Database file: {size_before / 2**20:.1f} MiB before, {size_after / 2**20:.1f} MiB after'
+              + ('' if vacuum else ' (run with --vacuum to reclaim free pages)') + '.')
+
+@app.cli.command('import-archive')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+def import_archive(paths):
+    """Load sessions written by flask retention back into the database as new sessions."""
+    def parse(value):
+        return datetime.datetime.fromisoformat(value) if value else None
+
+    imported = events = 0
+    for path in paths:
+        with gzip.open(path, 'rt') as archive:
+            for line in archive:
+                record = json.loads(line)
+                header = record['session']
+                # The old token is dropped so live batches can never be stitched onto a restored session
+                session = Session(ip_address=header['ip_address'], user_agent=header['user_agent'],
+                                  url=header['url'], timestamp=parse(header['timestamp']),
+                                  last_seen=parse(header['last_seen']))
+                db.session.add(session)
+                db.session.flush()
+                insert_events(session.id, [
+                    {'event_type': event_type, 'timestamp': parse(timestamp), 'x': x, 'y': y, 'additional_data': data}
+                    for event_type, timestamp, x, y, data in record['events']
+                ])
+                imported += 1
+                events += len(record['events'])
+                if imported % RETENTION_BATCH == 0:
+                    db.session.commit()
+    db.session.commit()
+    print(f'Imported {imported} sessions with {events} events; heatmaps already include them, '
+          f'so they were left unchanged.')
+
 @app.route('/generate_video/<int:session_id>', methods=['POST'])
 def generate_video(session_id):
-    return generate_real_browser_video(session_id)
+    mode = request.args.get('mode', 'real_browser')
+    if mode == 'composite':
+        return generate_composite_video(session_id)
+    if mode == 'real_browser':
+        return generate_real_browser_video(session_id)
+    return jsonify({'status': 'error', 'message': f'Unknown render mode: {mode}. Expected one of {RENDER_MODES}'}), 400
 
-def get_scroll_percentage(event):
+def get_scroll_percentage(additional_data):
+    if not additional_data:
+        return None
     try:
-        data = json.loads(event.additional_data)
+        data = json.loads(additional_data)
         scrollY = data.get('scrollY', 0)
         pageHeight = data.get('pageHeight', 1)
         percent = (scrollY / max(pageHeight, 1)) * 100
@@ -209,276 +1757,1320 @@ def get_scroll_percentage(event):
     except Exception:
         return None
 
-@app.route('/generate_real_browser_video/<int:session_id>', methods=['POST'])
-def generate_real_browser_video(session_id):
+# Videos are piped to ffmpeg as H.264 when it is available, otherwise written by OpenCV
+FFMPEG_BINARY = os.environ.get('MOUSEFLOW_FFMPEG') or shutil.which('ffmpeg')
+VIDEO_CRF = int(os.environ.get('MOUSEFLOW_VIDEO_CRF', 23))
+VIDEO_X264_PRESET = os.environ.get('MOUSEFLOW_X264_PRESET', 'veryfast')
+# OpenCV fallback, tried in order; the first fourcc this build can open is used for every render.
+# Only avc1/H264 play in browsers, so they go first
+VIDEO_CODECS = ['avc1', 'H264', 'mp4v', 'XVID', 'MJPG']
+_video_codec = None
+_video_codec_lock = threading.Lock()
+_video_encoder = None
+
+def select_video_encoder():
+    """'ffmpeg' if an ffmpeg with libx264 is available, else 'opencv'. Probed once per process."""
+    global _video_encoder
+    with _video_codec_lock:
+        if _video_encoder is None:
+            _video_encoder = 'opencv'
+            if FFMPEG_BINARY:
+                try:
+                    encoders = subprocess.run([FFMPEG_BINARY, '-hide_banner', '-encoders'],
+                                              capture_output=True, text=True, timeout=10).stdout
+                    if 'libx264' in encoders:
+                        _video_encoder = 'ffmpeg'
+                    else:
+                        app.logger.warning('%s has no libx264, falling back to OpenCV', FFMPEG_BINARY)
+                except (OSError, subprocess.SubprocessError):
+                    app.logger.warning('Could not run %s, falling back to OpenCV', FFMPEG_BINARY)
+        return _video_encoder
+
+def select_video_codec():
+    global _video_codec
+    with _video_codec_lock:
+        if _video_codec is None:
+            probe_dir = tempfile.mkdtemp(prefix='mouseflow_codec_')
+            try:
+                for codec in VIDEO_CODECS:
+                    probe_path = os.path.join(probe_dir, f'probe_{codec}.mp4')
+                    try:
+                        writer = cv2.VideoWriter(probe_path, cv2.VideoWriter_fourcc(*codec), 15, (64, 64))
+                        opened = writer.isOpened()
+                        writer.release()
+                    except Exception:
+                        continue
+                    if opened:
+                        _video_codec = codec
+                        break
+            finally:
+                shutil.rmtree(probe_dir, ignore_errors=True)
+            if _video_codec is None:
+                raise Exception("No compatible video codec found")
+        return _video_codec
+
+class VideoSink:
+    """Encodes frames as they arrive so memory stays flat however long the session is.
+
+    With ffmpeg the frames are piped to a separate encoder process, which runs alongside capture.
+    """
+
+    def __init__(self, path, fps, size=None, sampler=None):
+        self.path = path
+        self.fps = fps
+        self.sampler = sampler
+        self.encoder = select_video_encoder()
+        self.codec = 'h264' if self.encoder == 'ffmpeg' else select_video_codec()
+        self.writer = None
+        self.process = None
+        self.size = size
+        self.frames_written = 0
+
+    def open(self, width, height):
+        self.size = (width, height)
+        if self.encoder == 'ffmpeg':
+            self.errors = tempfile.TemporaryFile()
+            self.process = subprocess.Popen([
+                FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-y',
+                '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(self.fps), '-i', '-',
+                '-an', '-c:v', 'libx264', '-preset', VIDEO_X264_PRESET, '-crf', str(VIDEO_CRF),
+                # yuv420p (what browsers decode) needs even dimensions
+                '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p',
+                '-movflags', '+faststart', '-f', 'mp4', self.path
+            ], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self.errors)
+        else:
+            self.writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*self.codec), self.fps, self.size)
+            if not self.writer.isOpened():
+                raise Exception("Failed to create video writer")
+
+    def write(self, frame):
+        if self.size and (frame.shape[1], frame.shape[0]) != self.size:
+            frame = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        if self.sampler is not None:
+            self.sampler.add(frame)
+        if self.writer is None and self.process is None:
+            self.open(frame.shape[1], frame.shape[0])
+        if self.process is not None:
+            try:
+                self.process.stdin.write(np.ascontiguousarray(frame).tobytes())
+            except BrokenPipeError:
+                self.close()
+                raise Exception("ffmpeg stopped accepting frames")
+        else:
+            self.writer.write(frame)
+        self.frames_written += 1
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+        if self.process is not None:
+            process, self.process = self.process, None
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            returncode = process.wait()
+            self.errors.seek(0)
+            errors = self.errors.read().decode(errors='replace').strip()
+            self.errors.close()
+            if returncode != 0:
+                raise Exception(f"ffmpeg exited with {returncode}: {errors[-500:]}")
+
+class FrameSampler:
+    """Keeps small, evenly spaced copies of the frames seen so far, without knowing how many will come.
+
+    Once 2 * count samples are held, every other one is dropped and the sampling stride doubles.
+    """
+
+    def __init__(self, count, width):
+        self.count = count
+        self.width = width
+        self.stride = 1
+        self.seen = 0
+        self.samples = []
+
+    def wants(self):
+        return self.seen % self.stride == 0
+
+    def add(self, frame):
+        """Count a frame, keeping a copy if it falls on the stride; frame may be None when wants() is False."""
+        if self.wants():
+            height = max(1, round(frame.shape[0] * self.width / frame.shape[1]))
+            self.samples.append(cv2.resize(frame, (self.width, height), interpolation=cv2.INTER_AREA))
+            if len(self.samples) == 2 * self.count:
+                self.samples = self.samples[::2]
+                self.stride *= 2
+        self.seen += 1
+
+    def pick(self):
+        """count samples spread over the whole video, repeating some when fewer were kept."""
+        if not self.samples:
+            return []
+        return [self.samples[i] for i in np.linspace(0, len(self.samples) - 1, self.count).round().astype(int)]
+
+def build_chrome_options():
+    chrome_options = Options()
+    chrome_options.add_argument("--no-sandbox")
+    chrome_options.add_argument("--disable-dev-shm-usage")
+    chrome_options.add_argument("--disable-gpu")
+    chrome_options.add_argument(f"--window-size={VIEWPORT_WIDTH},{VIEWPORT_HEIGHT}")
+    chrome_options.add_argument("--disable-extensions")
+    chrome_options.add_argument("--disable-plugins")
+    chrome_options.add_argument("--headless")
+    chrome_options.add_argument("--disable-web-security")
+    chrome_options.add_argument("--disable-features=VizDisplayCompositor")
+    chrome_options.add_argument("--disable-popup-blocking")
+    chrome_options.add_argument("--disable-notifications")
+    chrome_options.add_argument("--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36 MOUSE_FLOW_VIDEO_GENERATION")
+    chrome_options.add_experimental_option("prefs", {
+        "profile.default_content_setting_values.notifications": 2,
+        "profile.default_content_settings.popups": 0
+    })
+    chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
+    chrome_options.add_experimental_option('useAutomationExtension', False)
+    return chrome_options
+
+_chromedriver_path = None
+_chromedriver_lock = threading.Lock()
+
+def chromedriver_path():
+    global _chromedriver_path
+    with _chromedriver_lock:
+        if _chromedriver_path is None:
+            _chromedriver_path = ChromeDriverManager().install()
+        return _chromedriver_path
+
+def launch_chrome():
+    return webdriver.Chrome(service=Service(chromedriver_path()), options=build_chrome_options())
+
+def quit_driver(driver):
     try:
-        session = Session.query.get_or_404(session_id)
-        events = sorted(session.events, key=lambda e: e.timestamp)
-        if not events:
-            return jsonify({'status': 'error', 'message': 'No events found for this session'}), 400
-        chrome_options = Options()
-        chrome_options.add_argument("--no-sandbox")
-        chrome_options.add_argument("--disable-dev-shm-usage")
-        chrome_options.add_argument("--disable-gpu")
-        chrome_options.add_argument("--window-size=1280,720")
-        chrome_options.add_argument("--disable-extensions")
-        chrome_options.add_argument("--disable-plugins")
-        chrome_options.add_argument("--headless")
-        chrome_options.add_argument("--disable-web-security")
-        chrome_options.add_argument("--disable-features=VizDisplayCompositor")
-        chrome_options.add_argument("--disable-popup-blocking")
-        chrome_options.add_argument("--disable-notifications")
-        chrome_options.add_argument("--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36 MOUSE_FLOW_VIDEO_GENERATION")
-        chrome_options.add_experimental_option("prefs", {
-            "profile.default_content_setting_values.notifications": 2,
-            "profile.default_content_settings.popups": 0
-        })
-        chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
-        chrome_options.add_experimental_option('useAutomationExtension', False)
-        driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=chrome_options)
+        driver.quit()
+    except Exception:
+        pass
+
+def reset_driver(driver):
+    for handle in driver.window_handles[1:]:
+        driver.switch_to.window(handle)
+        driver.close()
+    driver.switch_to.window(driver.window_handles[0])
+    origin = driver.execute_script("return window.location.origin")
+    if origin and origin != 'null':
+        driver.execute_cdp_cmd('Storage.clearDataForOrigin', {'origin': origin, 'storageTypes': 'all'})
+    driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+    driver.execute_cdp_cmd('Network.clearBrowserCache', {})
+    driver.get('about:blank')
+    driver.set_window_size(VIEWPORT_WIDTH, VIEWPORT_HEIGHT)
+
+def load_page(driver, url):
+    driver.get(url)
+    try:
+        WebDriverWait(driver, PAGE_READY_TIMEOUT).until(
+            lambda d: d.execute_script("return document.readyState") == 'complete')
+    except TimeoutException:
+        app.logger.warning('Page %s not ready after %ss, rendering anyway', url, PAGE_READY_TIMEOUT)
+
+class ChromePool:
+    def __init__(self, size, max_jobs):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.warmed_pid = None
+
+    def start_warming(self):
+        # Once per process: gunicorn forks its workers after importing the app, and threads do not survive a fork
+        with self.lock:
+            if self.warmed_pid == os.getpid():
+                return
+            self.warmed_pid = os.getpid()
+        threading.Thread(target=self.warm, name='mouseflow-chrome-warm', daemon=True).start()
+
+    def warm(self):
+        try:
+            while self.idle.qsize() < self.size:
+                self.idle.put((launch_chrome(), 0))
+        except Exception:
+            app.logger.exception('Failed to pre-launch Chrome')
+
+    @contextlib.contextmanager
+    def driver(self):
+        with self.slots:
+            try:
+                driver, jobs = self.idle.get_nowait()
+            except queue.Empty:
+                driver, jobs = launch_chrome(), 0
+            healthy = False
+            try:
+                yield driver
+                healthy = True
+            finally:
+                self.release(driver, jobs + 1, healthy)
+
+    def release(self, driver, jobs, healthy):
+        if not healthy or jobs >= self.max_jobs or self.idle.qsize() >= self.size:
+            quit_driver(driver)
+            return
+        try:
+            reset_driver(driver)
+        except Exception:
+            quit_driver(driver)
+            return
+        self.idle.put((driver, jobs))
+
+    def close(self):
+        while True:
+            try:
+                driver, _ = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            quit_driver(driver)
+
+chrome_pool = ChromePool(CHROME_POOL_SIZE, CHROME_MAX_JOBS)
+atexit.register(chrome_pool.close)
+
+@app.before_request
+def warm_chrome_pool():
+    # Under gunicorn this is each worker's startup, so its first render does not wait for Chrome to launch
+    if CHROME_WARM:
+        chrome_pool.start_warming()
+
+def session_target_url(session):
+    return session.url if session.url and session.url != 'unknown' else 'https://example.com'
+
+def render_settings(preset=DEFAULT_RENDER_PRESET, fps=None, width=None, idle_gap=None):
+    """Resolve a preset plus optional overrides; idle_gap=0 turns idle compression off."""
+    if preset not in RENDER_PRESETS:
+        raise ValueError(f'Unknown preset: {preset}. Expected one of {list(RENDER_PRESETS)}')
+    settings = dict(RENDER_PRESETS[preset], preset=preset)
+    if fps is not None:
+        if not 1 <= fps <= RENDER_MAX_FPS:
+            raise ValueError(f'fps must be between 1 and {RENDER_MAX_FPS}')
+        settings['fps'] = fps
+    if width is not None:
+        if not 160 <= width <= VIEWPORT_WIDTH:
+            raise ValueError(f'width must be between 160 and {VIEWPORT_WIDTH}')
+        # Even dimensions keep every encoder happy
+        settings['width'] = width // 2 * 2
+        settings['height'] = width * VIEWPORT_HEIGHT // VIEWPORT_WIDTH // 2 * 2
+    if idle_gap is not None:
+        if idle_gap and idle_gap < 4 * IDLE_HOLD_SECONDS:
+            raise ValueError(f'idle_gap must be 0 (off) or at least {4 * IDLE_HOLD_SECONDS:g} seconds')
+        settings['idle_gap'] = idle_gap or None
+    return settings
+
+def timeline_frame_times(event_offsets, total_duration, fps, idle_gap=None):
+    """Session time shown by each frame, and the seconds skipped on frames that show an idle card."""
+    step = 1.0 / fps
+    if not idle_gap:
+        total_frames = int(total_duration * fps)
+        return np.arange(total_frames, dtype=np.float64) * step, np.zeros(total_frames)
+    times, skips = [], []
+    position = 0.0
+    card_frames = max(1, round(IDLE_CARD_SECONDS * fps))
+    for i in np.nonzero(np.diff(event_offsets) > idle_gap)[0].tolist():
+        skip_from = event_offsets[i] + IDLE_HOLD_SECONDS
+        skip_to = event_offsets[i + 1] - IDLE_HOLD_SECONDS
+        played = np.arange(position, skip_from, step)
+        times += [played, np.full(card_frames, skip_from)]
+        skips += [np.zeros(len(played)), np.full(card_frames, skip_to - skip_from)]
+        position = skip_to
+    played = np.arange(position, total_duration, step)
+    return np.concatenate(times + [played]), np.concatenate(skips + [np.zeros(len(played))])
+
+def session_timeline(events, fps, idle_gap=None):
+    if len(events) > 1:
+        first_time = events[0].timestamp
+        last_time = events[-1].timestamp
+        total_duration = (last_time - first_time).total_seconds()
+        if total_duration < 0.1:
+            total_duration = max(0.5, len(events) * 0.1)
+    else:
+        total_duration = 1.0
+    event_offsets = getattr(events, 'offsets', None)
+    if event_offsets is None:
+        first_time = events[0].timestamp
+        event_offsets = np.fromiter(((evt.timestamp - first_time).total_seconds() for evt in events),
+                                    dtype=np.float64, count=len(events))
+    frame_times, frame_skips = timeline_frame_times(event_offsets, total_duration, fps, idle_gap)
+    # Index of the latest event at or before each frame, -1 before the first one
+    frame_events = np.searchsorted(event_offsets, frame_times, side='right') - 1
+    return total_duration, len(frame_times), frame_events, frame_times, frame_skips
+
+def timeline_frames(events, frame_events, frame_times, frame_skips):
+    previous_idx = -1
+    for frame_idx, (event_idx, frame_time, idle_skip) in enumerate(
+            zip(frame_events.tolist(), frame_times.tolist(), frame_skips.tolist())):
+        current_event = events[event_idx] if event_idx >= 0 else None
+        skipped = events[previous_idx + 1:event_idx] if event_idx > previous_idx + 1 else []
+        previous_idx = max(previous_idx, event_idx)
+        yield frame_idx, frame_time, current_event, event_idx, skipped, idle_skip
+
+def event_point(evt, width, height):
+    x = int(evt.x or 0)
+    y = int(evt.y or 0)
+    return max(0, min(x, width - 1)), max(0, min(y, height - 1))
+
+_trail_styles = {}
+
+def trail_style(length):
+    # (first point, last point, color) per brightness step for a trail of this many points
+    style = _trail_styles.get(length)
+    if style is None:
+        steps = min(TRAIL_FADE_STEPS, length - 1)
+        bounds = np.linspace(0, length - 1, steps + 1).astype(int).tolist()
+        colors = [tuple(int(c * max(0.1, 0.8 * (k + 1) / steps)) for c in TRAIL_COLORS['mousemove']) for k in range(steps)]
+        style = _trail_styles[length] = list(zip(bounds[:-1], bounds[1:], colors))
+    return style
+
+def draw_trail(frame, mouse_trail, page_width, page_height):
+    if len(mouse_trail) < 2:
+        return
+    points = np.array([(int(x or 0), int(y or 0)) for x, y, _ in mouse_trail], dtype=np.int32)
+    # One polyline per brightness step instead of one circle per point; the newest segment is brightest
+    for first, last, color in trail_style(len(points)):
+        cv2.polylines(frame, [points[first:last + 1]], False, color, 2)
+    for j, (x, y, trail_type) in enumerate(mouse_trail[:-1]):
+        if trail_type in ('click', 'scroll') and 0 <= points[j][0] < page_width and 0 <= points[j][1] < page_height:
+            alpha = max(0.1, 0.8 * (j + 1) / len(mouse_trail))
+            color = tuple(int(c * alpha) for c in TRAIL_COLORS[trail_type])
+            cv2.circle(frame, (int(points[j][0]), int(points[j][1])), 4, color, -1)
+
+def draw_cursor_shapes(canvas, x, y, event_type):
+    if event_type == 'click':
+        cv2.circle(canvas, (x, y), 15, (255, 255, 255), 4)
+        cv2.circle(canvas, (x, y), 12, (0, 0, 255), -1)
+        cv2.circle(canvas, (x, y), 8, (255, 255, 255), 2)
+        cv2.putText(canvas, "CLICK", (x + 20, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
+    elif event_type == 'mousemove':
+        cv2.circle(canvas, (x, y), 12, (255, 255, 255), 3)
+        cv2.circle(canvas, (x, y), 10, (0, 255, 0), -1)
+        cv2.circle(canvas, (x, y), 6, (255, 255, 255), 2)
+    elif event_type == 'scroll':
+        cv2.circle(canvas, (x, y), 12, (255, 255, 255), 3)
+        cv2.circle(canvas, (x, y), 10, (255, 0, 0), -1)
+        cv2.circle(canvas, (x, y), 6, (255, 255, 255), 2)
+        cv2.putText(canvas, "SCROLL", (x + 20, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 0, 0), 2)
+    cv2.arrowedLine(canvas, (x - 15, y - 15), (x, y), (255, 255, 255), 2, tipLength=0.3)
+
+_cursor_sprites = {}
+
+def cursor_sprite(event_type):
+    sprite = _cursor_sprites.get(event_type)
+    if sprite is None:
+        # Drawn once on black and once on white: the black render is the color premultiplied by
+        # alpha, and the difference between the two is how much background shows through
+        left, top = CURSOR_SPRITE_ANCHOR
+        dark = np.zeros(CURSOR_SPRITE_SHAPE + (3,), dtype=np.uint8)
+        light = np.full(CURSOR_SPRITE_SHAPE + (3,), 255, dtype=np.uint8)
+        draw_cursor_shapes(dark, left, top, event_type)
+        draw_cursor_shapes(light, left, top, event_type)
+        transparency = (light.astype(np.float32) - dark) / 255.0
+        sprite = _cursor_sprites[event_type] = (dark.astype(np.float32) + 0.5, transparency)
+    return sprite
+
+def draw_cursor(frame, x, y, event_type):
+    color, transparency = cursor_sprite(event_type)
+    left, top = CURSOR_SPRITE_ANCHOR
+    x0, y0 = x - left, y - top
+    fx0, fy0 = max(x0, 0), max(y0, 0)
+    fx1, fy1 = min(x0 + color.shape[1], frame.shape[1]), min(y0 + color.shape[0], frame.shape[0])
+    if fx0 >= fx1 or fy0 >= fy1:
+        return
+    rows = slice(fy0 - y0, fy1 - y0)
+    cols = slice(fx0 - x0, fx1 - x0)
+    roi = frame[fy0:fy1, fx0:fx1]
+    roi[:] = roi * transparency[rows, cols] + color[rows, cols]
+
+def draw_hud(frame, current_time, total_duration, current_event, current_event_idx, event_count):
+    # Darken just the HUD box in place rather than blending a copy of the whole frame
+    hud = frame[10:101, 10:451]
+    hud[:] = cv2.convertScaleAbs(hud, alpha=0.7)
+    cv2.putText(frame, f"Session Time: {current_time:.1f}s / {total_duration:.1f}s", 
+               (15, 35), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
+    if current_event:
+        cv2.putText(frame, f"Event {current_event_idx + 1}/{event_count}: {current_event.event_type}", 
+                   (15, 60), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
+        cv2.putText(frame, f"Event Time: {current_event.timestamp.strftime('%H:%M:%S.%f')[:-3]}", 
+                   (15, 85), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+        x, y = current_event.x or 0, current_event.y or 0
+        cv2.putText(frame, f"Position: ({x}, {y})", 
+                   (15, 105), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1)
+    else:
+        cv2.putText(frame, "Waiting for next event...", 
+                   (15, 60), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
+
+def draw_idle_card(frame, seconds):
+    height, width = frame.shape[:2]
+    text = f"Skipped {seconds:.0f}s of inactivity"
+    (text_width, text_height), _ = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.8, 2)
+    x0, y0 = (width - text_width) // 2 - 20, (height - text_height) // 2 - 20
+    card = frame[max(y0, 0):y0 + text_height + 40, max(x0, 0):x0 + text_width + 40]
+    card[:] = cv2.convertScaleAbs(card, alpha=0.3)
+    cv2.putText(frame, text, (x0 + 20, y0 + 20 + text_height), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
+
+def replay_event(driver, evt, x, y, last_x, last_y, timings):
+    delta_x = x - last_x
+    delta_y = y - last_y
+    if evt.event_type == 'mousemove':
+        actions = ActionChains(driver)
+        actions.move_by_offset(delta_x, delta_y)
+        started = time.perf_counter()
+        actions.perform()
+        timings.add('input_actions', time.perf_counter() - started)
+        started = time.perf_counter()
+        driver.execute_script(f"""
+            var event = new MouseEvent('mousemove', {{
+                'view': window,
+                'bubbles': true,
+                'cancelable': true,
+                'clientX': {x},
+                'clientY': {y}
+            }});
+            var element = document.elementFromPoint({x}, {y});
+            if (element) {{
+                element.dispatchEvent(event);
+            }}
+        """)
+        driver.execute_script(f"""
+            var element = document.elementFromPoint({x}, {y});
+            if (element) {{
+                element.dispatchEvent(new MouseEvent('mouseenter', {{
+                    'view': window,
+                    'bubbles': true,
+                    'cancelable': true,
+                    'clientX': {x},
+                    'clientY': {y}
+                }}));
+            }}
+        """)
+        timings.add('dispatch_script', time.perf_counter() - started)
+    elif evt.event_type == 'click':
+        actions = ActionChains(driver)
+        actions.move_by_offset(delta_x, delta_y)
+        actions.click()
+        started = time.perf_counter()
+        actions.perform()
+        timings.add('input_actions', time.perf_counter() - started)
+        started = time.perf_counter()
+        driver.execute_script(f"""
+            var element = document.elementFromPoint({x}, {y});
+            if (element) {{
+                var clickEvent = new MouseEvent('click', {{
+                    'view': window,
+                    'bubbles': true,
+                    'cancelable': true,
+                    'clientX': {x},
+                    'clientY': {y}
+                }});
+                element.dispatchEvent(clickEvent);
+                element.dispatchEvent(new MouseEvent('mousedown', {{
+                    'view': window,
+                    'bubbles': true,
+                    'cancelable': true,
+                    'clientX': {x},
+                    'clientY': {y}
+                }}));
+                element.dispatchEvent(new MouseEvent('mouseup', {{
+                    'view': window,
+                    'bubbles': true,
+                    'cancelable': true,
+                    'clientX': {x},
+                    'clientY': {y}
+                }}));
+            }}
+        """)
+        timings.add('dispatch_script', time.perf_counter() - started)
+    elif evt.event_type == 'scroll':
+        try:
+            scroll_data = json.loads(evt.additional_data) if evt.additional_data else {}
+            scroll_y = scroll_data.get('scrollY', 0)
+            with timings.stage('dispatch_script'):
+                driver.execute_script(f"window.scrollTo(0, {scroll_y})")
+        except:
+            pass
+
+class DevToolsSession:
+    """A second DevTools connection to the tab a Selenium driver controls, run by trio on its own thread.
+
+    Screencast frames are decoded and acknowledged on that thread as Chrome pushes them, and
+    commands are written without waiting for their replies.
+    """
+
+    def __init__(self, driver, timings):
+        address = driver.capabilities['goog:chromeOptions']['debuggerAddress']
+        # ChromeDriver window handles are DevTools target ids
+        self.url = f'ws://{address}/devtools/page/{driver.current_window_handle}'
+        self.timings = timings
+        self.ids = itertools.count(1)
+        self.frame = None
+        self.has_frame = threading.Event()
+        self.connected = threading.Event()
+        self.error = None
+        self.token = None
+        self.cancel_scope = None
+        self.websocket = None
+        self.thread = threading.Thread(target=trio.run, args=(self.run,), name='mouseflow-devtools', daemon=True)
+
+    def start(self, timeout):
+        self.thread.start()
+        if not self.connected.wait(timeout) or self.error:
+            self.stop()
+            raise RuntimeError(f'DevTools connection to {self.url} failed: {self.error or "timed out"}')
+
+    async def run(self):
+        self.token = trio.lowlevel.current_trio_token()
+        try:
+            with trio.CancelScope() as self.cancel_scope:
+                async with trio_websocket.open_websocket_url(self.url, max_message_size=SCREENCAST_MAX_MESSAGE) as websocket:
+                    self.websocket = websocket
+                    await self.send_commands([('Page.startScreencast', {
+                        'format': 'jpeg', 'quality': SCREENCAST_JPEG_QUALITY,
+                        'maxWidth': VIEWPORT_WIDTH, 'maxHeight': VIEWPORT_HEIGHT, 'everyNthFrame': 1})])
+                    self.connected.set()
+                    while True:
+                        message = json.loads(await websocket.get_message())
+                        if message.get('method') == 'Page.screencastFrame':
+                            self.receive_frame(message['params']['data'])
+                            # Chrome sends the next frame only once this one is acknowledged
+                            await self.send_commands([('Page.screencastFrameAck',
+                                                       {'sessionId': message['params']['sessionId']})])
+                        elif 'error' in message:
+                            app.logger.warning('DevTools command %s failed: %s', message.get('id'), message['error'])
+        except Exception as e:
+            self.error = str(e) or type(e).__name__
+        finally:
+            self.connected.set()
+            self.has_frame.set()
+
+    def receive_frame(self, data):
+        start = time.perf_counter()
+        frame = cv2.imdecode(np.frombuffer(base64.b64decode(data), dtype=np.uint8), cv2.IMREAD_COLOR)
+        if frame is None:
+            return
+        if frame.shape[:2] != (VIEWPORT_HEIGHT, VIEWPORT_WIDTH):
+            frame = cv2.resize(frame, (VIEWPORT_WIDTH, VIEWPORT_HEIGHT), interpolation=cv2.INTER_AREA)
+        self.frame = frame
+        self.has_frame.set()
+        self.timings.add('decode', time.perf_counter() - start)
+
+    async def send_commands(self, commands):
+        for method, params in commands:
+            await self.websocket.send_message(json.dumps({'id': next(self.ids), 'method': method, 'params': params}))
+
+    def send(self, commands):
+        if self.error:
+            raise RuntimeError(f'DevTools connection lost: {self.error}')
+        if commands:
+            trio.from_thread.run(self.send_commands, commands, trio_token=self.token)
+
+    def latest_frame(self, timeout):
+        if not self.has_frame.wait(timeout) or self.frame is None:
+            raise RuntimeError(f'No screencast frame received: {self.error or "timed out"}')
+        return self.frame
+
+    def stop(self):
+        if self.token is not None and self.thread.is_alive():
+            with contextlib.suppress(Exception):
+                trio.from_thread.run(self.websocket.aclose, trio_token=self.token)
+            with contextlib.suppress(trio.RunFinishedError):
+                trio.from_thread.run_sync(self.cancel_scope.cancel, trio_token=self.token)
+        self.thread.join(timeout=5)
+
+class ScreenshotCapture:
+    """WebDriver capture: ActionChains and execute_script per event, then a PNG screenshot per frame."""
+
+    def __init__(self, driver, fps, page_height, timings):
+        self.driver = driver
+        self.frame_interval = 1.0 / fps
+        self.timings = timings
+        self.last_x, self.last_y = 0, 0
+
+    def replay(self, points, current_event):
+        for evt, x, y in points:
+            try:
+                replay_event(self.driver, evt, x, y, self.last_x, self.last_y, self.timings)
+                self.last_x, self.last_y = x, y
+                if evt is current_event:
+                    with self.timings.stage('sleep'):
+                        time.sleep(0.05)
+            except Exception:
+                pass
+
+    def grab(self):
+        with self.timings.stage('screenshot'):
+            screenshot = self.driver.get_screenshot_as_png()
+        with self.timings.stage('decode'):
+            return cv2.imdecode(np.frombuffer(screenshot, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    def wait(self):
+        with self.timings.stage('sleep'):
+            time.sleep(self.frame_interval)
+
+    def close(self):
+        pass
+
+class ScreencastCapture:
+    """DevTools capture: a JPEG screencast plus one trusted-input batch per frame, with no WebDriver round trips."""
+
+    def __init__(self, driver, fps, page_height, timings):
+        self.frame_interval = 1.0 / fps
+        self.page_height = page_height
+        self.timings = timings
+        self.devtools = DevToolsSession(driver, timings)
+        self.devtools.start(SCREENCAST_TIMEOUT)
+        self.next_frame_at = time.monotonic()
+
+    def replay(self, points, current_event):
+        commands = []
+        for evt, x, y in points:
+            if evt.event_type == 'scroll':
+                commands.append(('Runtime.evaluate', {
+                    'expression': f'window.scrollTo(0, {scroll_offset(evt, self.page_height)})'}))
+                continue
+            # Input.dispatchMouseEvent takes viewport coordinates
+            point = {'x': min(x, VIEWPORT_WIDTH - 1), 'y': min(y, VIEWPORT_HEIGHT - 1)}
+            commands.append(('Input.dispatchMouseEvent', dict(point, type='mouseMoved')))
+            if evt.event_type == 'click':
+                for kind in ('mousePressed', 'mouseReleased'):
+                    commands.append(('Input.dispatchMouseEvent', dict(point, type=kind, button='left', clickCount=1)))
+        with self.timings.stage('dispatch_input'):
+            self.devtools.send(commands)
+
+    def grab(self):
+        with self.timings.stage('frame_wait'):
+            # Overlays are drawn on the returned frame, and the same screencast frame may be grabbed again
+            return self.devtools.latest_frame(SCREENCAST_TIMEOUT).copy()
+
+    def wait(self):
+        # Frames are grabbed no faster than fps, but no time is added when capture already falls behind
+        self.next_frame_at = max(self.next_frame_at + self.frame_interval, time.monotonic())
+        with self.timings.stage('sleep'):
+            time.sleep(max(0.0, self.next_frame_at - time.monotonic()))
+
+    def close(self):
+        with contextlib.suppress(Exception):
+            self.devtools.send([('Page.stopScreencast', {})])
+        self.devtools.stop()
+
+def open_capture(backend, driver, fps, page_height, timings):
+    if backend not in CAPTURE_BACKENDS:
+        raise ValueError(f'Unknown capture backend: {backend}')
+    if backend == 'screencast':
         try:
-            target_url = session.url if hasattr(session, 'url') and session.url and session.url != 'unknown' else 'https://example.com'
-            driver.get(target_url)
-            time.sleep(3)
-            driver.set_window_size(1280, 720)
+            return ScreencastCapture(driver, fps, page_height, timings)
+        except Exception:
+            app.logger.warning('Screencast capture unavailable, falling back to screenshots', exc_info=True)
+    return ScreenshotCapture(driver, fps, page_height, timings)
+
+def capture_real_browser(session, events, sink, fps, progress=None, idle_gap=None, timings=None, backend=None):
+    timings = timings or StageTimer('real_browser')
+    started = time.perf_counter()
+    with chrome_pool.driver() as driver:
+        # Waiting for a pool slot, plus launching Chrome when no warm instance is idle
+        timings.add('chrome_acquire', time.perf_counter() - started)
+        with timings.stage('page_load'):
+            load_page(driver, session_target_url(session))
+            driver.set_window_size(VIEWPORT_WIDTH, VIEWPORT_HEIGHT)
             page_width = driver.execute_script("return document.documentElement.scrollWidth")
             page_height = driver.execute_script("return document.documentElement.scrollHeight")
-            frames = []
-            fps = 15
-            if len(events) > 1:
-                first_time = events[0].timestamp
-                last_time = events[-1].timestamp
-                total_duration = (last_time - first_time).total_seconds()
-                if total_duration < 0.1:
-                    total_duration = max(0.5, len(events) * 0.1)
-            else:
-                total_duration = 1.0
-            frame_interval = 1.0 / fps
-            total_frames = int(total_duration * fps)
-            event_timeline = []
-            for i, evt in enumerate(events):
-                event_time = (evt.timestamp - events[0].timestamp).total_seconds()
-                event_timeline.append((event_time, evt, i))
-            last_x, last_y = 0, 0
+        total_duration, total_frames, frame_events, frame_times, frame_skips = session_timeline(events, fps, idle_gap)
+        capture = open_capture(backend or CAPTURE_BACKEND, driver, fps, page_height, timings)
+        try:
             mouse_trail = []
-            max_trail_length = 30
-            for frame_idx in range(total_frames):
-                current_time = frame_idx * frame_interval
-                current_event = None
-                current_event_idx = -1
-                for event_time, evt, evt_idx in event_timeline:
-                    if event_time <= current_time:
-                        current_event = evt
-                        current_event_idx = evt_idx
-                    else:
-                        break
-                if current_event:
-                    try:
-                        x, y = current_event.x or 0, current_event.y or 0
-                        x = int(x) if x is not None else 0
-                        y = int(y) if y is not None else 0
-                        x = max(0, min(x, page_width - 1))
-                        y = max(0, min(y, page_height - 1))
-                        mouse_trail.append((x, y, current_event.event_type))
-                        if len(mouse_trail) > max_trail_length:
-                            mouse_trail.pop(0)
-                        delta_x = x - last_x
-                        delta_y = y - last_y
-                        if current_event.event_type == 'mousemove':
-                            actions = ActionChains(driver)
-                            actions.move_by_offset(delta_x, delta_y)
-                            actions.perform()
-                            driver.execute_script(f"""
-                                var event = new MouseEvent('mousemove', {{
-                                    'view': window,
-                                    'bubbles': true,
-                                    'cancelable': true,
-                                    'clientX': {x},
-                                    'clientY': {y}
-                                }});
-                                var element = document.elementFromPoint({x}, {y});
-                                if (element) {{
-                                    element.dispatchEvent(event);
-                                }}
-                            """)
-                            driver.execute_script(f"""
-                                var element = document.elementFromPoint({x}, {y});
-                                if (element) {{
-                                    element.dispatchEvent(new MouseEvent('mouseenter', {{
-                                        'view': window,
-                                        'bubbles': true,
-                                        'cancelable': true,
-                                        'clientX': {x},
-                                        'clientY': {y}
-                                    }}));
-                                }}
-                            """)
-                        elif current_event.event_type == 'click':
-                            actions = ActionChains(driver)
-                            actions.move_by_offset(delta_x, delta_y)
-                            actions.click()
-                            actions.perform()
-                            driver.execute_script(f"""
-                                var element = document.elementFromPoint({x}, {y});
-                                if (element) {{
-                                    var clickEvent = new MouseEvent('click', {{
-                                        'view': window,
-                                        'bubbles': true,
-                                        'cancelable': true,
-                                        'clientX': {x},
-                                        'clientY': {y}
-                                    }});
-                                    element.dispatchEvent(clickEvent);
-                                    element.dispatchEvent(new MouseEvent('mousedown', {{
-                                        'view': window,
-                                        'bubbles': true,
-                                        'cancelable': true,
-                                        'clientX': {x},
-                                        'clientY': {y}
-                                    }}));
-                                    element.dispatchEvent(new MouseEvent('mouseup', {{
-                                        'view': window,
-                                        'bubbles': true,
-                                        'cancelable': true,
-                                        'clientX': {x},
-                                        'clientY': {y}
-                                    }}));
-                                }}
-                            """)
-                        elif current_event.event_type == 'scroll':
-                            try:
-                                scroll_data = json.loads(current_event.additional_data) if current_event.additional_data else {}
-                                scroll_y = scroll_data.get('scrollY', 0)
-                                driver.execute_script(f"window.scrollTo(0, {scroll_y})")
-                            except:
-                                pass
-                        last_x, last_y = x, y
-                        time.sleep(0.05)
-                    except Exception:
-                        pass
-                screenshot = driver.get_screenshot_as_png()
-                screenshot_array = np.frombuffer(screenshot, dtype=np.uint8)
-                frame = cv2.imdecode(screenshot_array, cv2.IMREAD_COLOR)
-                if frame is None or frame.size == 0:
-                    frame = np.ones((720, 1280, 3), dtype=np.uint8) * 255
-                for j, (trail_x, trail_y, trail_type) in enumerate(mouse_trail[:-1]):
-                    try:
-                        trail_x = int(trail_x) if trail_x is not None else 0
-                        trail_y = int(trail_y) if trail_y is not None else 0
-                        if (trail_x >= 0 and trail_y >= 0 and trail_x < page_width and trail_y < page_height):
-                            fade_factor = 1.0 - (j / len(mouse_trail))
-                            alpha = max(0.1, fade_factor * 0.8)
-                            if trail_type == 'click':
-                                color = (int(255 * alpha), int(100 * alpha), int(100 * alpha))
-                                radius = int(3 + 2 * alpha)
-                            elif trail_type == 'scroll':
-                                color = (int(100 * alpha), int(100 * alpha), int(255 * alpha))
-                                radius = int(2 + 2 * alpha)
-                            else:
-                                color = (int(100 * alpha), int(255 * alpha), int(100 * alpha))
-                                radius = int(2 + 1 * alpha)
-                            cv2.circle(frame, (trail_x, trail_y), radius, color, -1)
-                    except (ValueError, TypeError):
+            idle_card = None
+            for frame_idx, current_time, current_event, current_event_idx, skipped, idle_skip in timeline_frames(
+                    events, frame_events, frame_times, frame_skips):
+                # Nothing happens during a collapsed pause, so its card is captured once and repeated
+                if idle_skip and idle_card is not None:
+                    with timings.stage('encode'):
+                        sink.write(idle_card)
+                    if progress:
+                        progress(frame_idx + 1, total_frames)
+                    continue
+                idle_card = None
+                # Clicks that fell between two frames are still replayed so their effects show up,
+                # and so is the last such scroll, so the page stays where the visitor left it
+                last_scroll = next((evt for evt in reversed(skipped) if evt.event_type == 'scroll'), None)
+                points = []
+                for evt in [evt for evt in skipped if evt.event_type == 'click' or evt is last_scroll] + [current_event]:
+                    if evt is None:
                         continue
-                if current_event:
                     try:
-                        x, y = current_event.x or 0, current_event.y or 0
-                        x = int(x) if x is not None else 0
-                        y = int(y) if y is not None else 0
-                        x = max(0, min(x, page_width - 1))
-                        y = max(0, min(y, page_height - 1))
-                        if current_event.event_type == 'click':
-                            cv2.circle(frame, (x, y), 15, (255, 255, 255), 4)
-                            cv2.circle(frame, (x, y), 12, (0, 0, 255), -1)
-                            cv2.circle(frame, (x, y), 8, (255, 255, 255), 2)
-                            cv2.putText(frame, "CLICK", (x + 20, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
-                        elif current_event.event_type == 'mousemove':
-                            cv2.circle(frame, (x, y), 12, (255, 255, 255), 3)
-                            cv2.circle(frame, (x, y), 10, (0, 255, 0), -1)
-                            cv2.circle(frame, (x, y), 6, (255, 255, 255), 2)
-                        elif current_event.event_type == 'scroll':
-                            cv2.circle(frame, (x, y), 12, (255, 255, 255), 3)
-                            cv2.circle(frame, (x, y), 10, (255, 0, 0), -1)
-                            cv2.circle(frame, (x, y), 6, (255, 255, 255), 2)
-                            cv2.putText(frame, "SCROLL", (x + 20, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 0, 0), 2)
-                        cv2.arrowedLine(frame, (x - 15, y - 15), (x, y), (255, 255, 255), 2, tipLength=0.3)
+                        x, y = event_point(evt, page_width, page_height)
                     except (ValueError, TypeError):
-                        pass
-                overlay = frame.copy()
-                cv2.rectangle(overlay, (10, 10), (450, 100), (0, 0, 0), -1)
-                cv2.addWeighted(overlay, 0.3, frame, 0.7, 0, frame)
-                cv2.putText(frame, f"Session Time: {current_time:.1f}s / {total_duration:.1f}s", 
-                           (15, 35), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
-                if current_event:
-                    cv2.putText(frame, f"Event {current_event_idx + 1}/{len(events)}: {current_event.event_type}", 
-                               (15, 60), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
-                    cv2.putText(frame, f"Event Time: {current_event.timestamp.strftime('%H:%M:%S.%f')[:-3]}", 
-                               (15, 85), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
-                    x, y = current_event.x or 0, current_event.y or 0
-                    cv2.putText(frame, f"Position: ({x}, {y})", 
-                               (15, 105), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1)
-                else:
-                    cv2.putText(frame, "Waiting for next event...", 
-                               (15, 60), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
-                frames.append(frame)
-                time.sleep(frame_interval)
-            if not frames:
-                screenshot = driver.get_screenshot_as_png()
-                screenshot_array = np.frombuffer(screenshot, dtype=np.uint8)
-                frame = cv2.imdecode(screenshot_array, cv2.IMREAD_COLOR)
-                frames.append(frame)
+                        continue
+                    mouse_trail.append((x, y, evt.event_type))
+                    points.append((evt, x, y))
+                capture.replay(points, current_event)
+                del mouse_trail[:-MAX_TRAIL_LENGTH]
+                frame = capture.grab()
+                if frame is None or frame.size == 0:
+                    frame = np.ones((VIEWPORT_HEIGHT, VIEWPORT_WIDTH, 3), dtype=np.uint8) * 255
+                with timings.stage('overlay'):
+                    draw_trail(frame, mouse_trail, page_width, page_height)
+                    if current_event:
+                        try:
+                            x, y = event_point(current_event, page_width, page_height)
+                            draw_cursor(frame, x, y, current_event.event_type)
+                        except (ValueError, TypeError):
+                            pass
+                    draw_hud(frame, current_time, total_duration, current_event, current_event_idx, len(events))
+                    if idle_skip:
+                        draw_idle_card(frame, idle_skip)
+                        idle_card = frame
+                with timings.stage('encode'):
+                    sink.write(frame)
+                if progress:
+                    progress(frame_idx + 1, total_frames)
+                capture.wait()
+            if sink.frames_written == 0:
+                frame = capture.grab()
+                if frame is None:
+                    raise Exception("No frames captured")
+                sink.write(frame)
         finally:
-            driver.quit()
-        video_dir = os.path.join('static', 'videos')
-        os.makedirs(video_dir, exist_ok=True)
-        if frames:
-            height, width = frames[0].shape[:2]
-            codecs_to_try = [
-                ('XVID', '.mp4'),
-                ('MJPG', '.mp4'),
-                ('mp4v', '.mp4'),
-                ('avc1', '.mp4'),
-                ('H264', '.mp4')
-            ]
-            out_path = None
-            fourcc = None
-            selected_codec = None
-            for codec, ext in codecs_to_try:
-                try:
-                    test_path = os.path.join(video_dir, f'test_real_browser_{session_id}{ext}')
-                    fourcc = cv2.VideoWriter_fourcc(*codec)
-                    test_writer = cv2.VideoWriter(test_path, fourcc, fps, (width, height))
-                    if test_writer.isOpened():
-                        test_writer.release()
-                        os.remove(test_path)
-                        out_path = os.path.join(video_dir, f'session_{session_id}_real_browser{ext}')
-                        selected_codec = codec
-                        break
-                except Exception:
-                    continue
-            if out_path is None:
-                raise Exception("No compatible video codec found")
-            out = cv2.VideoWriter(out_path, fourcc, fps, (width, height))
-            if not out.isOpened():
-                raise Exception("Failed to create video writer")
-            for i, frame in enumerate(frames):
-                out.write(frame)
-            out.release()
-            if not os.path.exists(out_path) or os.path.getsize(out_path) == 0:
-                raise Exception("Real browser video file was not created or is empty")
-            video_path = f'/static/videos/session_{session_id}_real_browser{os.path.splitext(out_path)[1]}'
-        else:
-            raise Exception("No frames captured")
-        return jsonify({
-            'status': 'video_generated',
-            'session_id': session_id,
-            'video_path': video_path,
-            'type': 'real_browser',
-            'video_duration_seconds': total_frames / fps,
-            'session_duration_seconds': total_duration
+            capture.close()
+    return total_duration, total_frames
+
+def page_cache_path(session_id):
+    return os.path.join(PAGE_CACHE_DIR, f'session_{session_id}.png')
+
+def poster_path(session_id):
+    return os.path.join(THUMBNAIL_DIR, f'session_{session_id}_poster.jpg')
+
+def sprite_path(session_id):
+    return os.path.join(THUMBNAIL_DIR, f'session_{session_id}_sprite.jpg')
+
+def thumbnail_paths(session_id):
+    return [poster_path(session_id), sprite_path(session_id)]
+
+def write_jpeg(path, image):
+    ok, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, THUMBNAIL_JPEG_QUALITY])
+    if not ok:
+        raise Exception(f"Failed to encode {path}")
+    # Replaced in one step so a dashboard request never reads half a file
+    partial_path = path + '.partial'
+    with open(partial_path, 'wb') as f:
+        f.write(jpeg.tobytes())
+    os.replace(partial_path, path)
+
+def write_thumbnails(session_id, sampler):
+    """Write the poster (a frame a third of the way in) and a one-row sprite of SPRITE_FRAMES frames."""
+    frames = sampler.pick()
+    if not frames:
+        return False
+    os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+    write_jpeg(poster_path(session_id), frames[len(frames) // 3])
+    height = max(1, round(frames[0].shape[0] * SPRITE_FRAME_WIDTH / frames[0].shape[1]))
+    write_jpeg(sprite_path(session_id), np.hstack([
+        cv2.resize(frame, (SPRITE_FRAME_WIDTH, height), interpolation=cv2.INTER_AREA) for frame in frames]))
+    return True
+
+def capture_full_page(session):
+    path = page_cache_path(session.id)
+    if os.path.exists(path):
+        page = cv2.imread(path, cv2.IMREAD_COLOR)
+        if page is not None:
+            return page
+    with chrome_pool.driver() as driver:
+        load_page(driver, session_target_url(session))
+        driver.set_window_size(VIEWPORT_WIDTH, VIEWPORT_HEIGHT)
+        page_height = driver.execute_script("return document.documentElement.scrollHeight")
+        page_height = max(VIEWPORT_HEIGHT, min(int(page_height or 0), PAGE_CAPTURE_MAX_HEIGHT))
+        screenshot = driver.execute_cdp_cmd('Page.captureScreenshot', {
+            'format': 'png',
+            'captureBeyondViewport': True,
+            'clip': {'x': 0, 'y': 0, 'width': VIEWPORT_WIDTH, 'height': page_height, 'scale': 1}
         })
-    except Exception as e:
-        return jsonify({'status': 'error', 'message': f'Failed to generate real browser video: {str(e)}'}), 500
+    page = cv2.imdecode(np.frombuffer(base64.b64decode(screenshot['data']), dtype=np.uint8), cv2.IMREAD_COLOR)
+    if page is None:
+        raise Exception("Failed to capture page screenshot")
+    if page.shape[1] != VIEWPORT_WIDTH:
+        page = cv2.resize(page, (VIEWPORT_WIDTH, int(page.shape[0] * VIEWPORT_WIDTH / page.shape[1])))
+    if page.shape[0] < VIEWPORT_HEIGHT:
+        page = cv2.copyMakeBorder(page, 0, VIEWPORT_HEIGHT - page.shape[0], 0, 0, cv2.BORDER_CONSTANT, value=(255, 255, 255))
+    os.makedirs(PAGE_CACHE_DIR, exist_ok=True)
+    cv2.imwrite(path, page)
+    return page
+
+def scroll_offset(evt, page_height):
+    max_scroll = max(page_height - VIEWPORT_HEIGHT, 0)
+    try:
+        data = json.loads(evt.additional_data) if evt.additional_data else {}
+    except ValueError:
+        data = {}
+    if isinstance(data, dict) and 'scrollY' in data:
+        offset = int(data['scrollY'] or 0)
+    else:
+        # The tracker reports scroll position as a percentage in y
+        offset = int(max_scroll * float(evt.y or 0) / 100)
+    return max(0, min(offset, max_scroll))
+
+def composite_session(page, events, sink, fps, progress=None, idle_gap=None, timings=None):
+    timings = timings or StageTimer('composite')
+    page_height = page.shape[0]
+    total_duration, total_frames, frame_events, frame_times, frame_skips = session_timeline(events, fps, idle_gap)
+    scroll_y = 0
+    pointer_x, pointer_y = 0, 0
+    mouse_trail = []
+    idle_card = None
+    for frame_idx, current_time, current_event, current_event_idx, skipped, idle_skip in timeline_frames(
+            events, frame_events, frame_times, frame_skips):
+        if idle_skip and idle_card is not None:
+            with timings.stage('encode'):
+                sink.write(idle_card)
+            if progress:
+                progress(frame_idx + 1, total_frames)
+            continue
+        idle_card = None
+        missed_click = None
+        for evt in skipped + ([current_event] if current_event else []):
+            if evt.event_type == 'scroll':
+                scroll_y = scroll_offset(evt, page_height)
+            else:
+                try:
+                    pointer_x, pointer_y = event_point(evt, VIEWPORT_WIDTH, VIEWPORT_HEIGHT)
+                except (ValueError, TypeError):
+                    pass
+            if evt is not current_event and evt.event_type == 'click':
+                missed_click = (pointer_x, pointer_y)
+                mouse_trail.append((pointer_x, pointer_y, 'click'))
+        if current_event:
+            mouse_trail.append((pointer_x, pointer_y, current_event.event_type))
+            del mouse_trail[:-MAX_TRAIL_LENGTH]
+        with timings.stage('crop'):
+            frame = page[scroll_y:scroll_y + VIEWPORT_HEIGHT].copy()
+        with timings.stage('overlay'):
+            draw_trail(frame, mouse_trail, VIEWPORT_WIDTH, VIEWPORT_HEIGHT)
+            if missed_click and current_event and current_event.event_type != 'click':
+                draw_cursor(frame, missed_click[0], missed_click[1], 'click')
+            if current_event:
+                draw_cursor(frame, pointer_x, pointer_y, current_event.event_type)
+            draw_hud(frame, current_time, total_duration, current_event, current_event_idx, len(events))
+            if idle_skip:
+                draw_idle_card(frame, idle_skip)
+                idle_card = frame
+        with timings.stage('encode'):
+            sink.write(frame)
+        if progress:
+            progress(frame_idx + 1, total_frames)
+    if sink.frames_written == 0:
+        sink.write(page[:VIEWPORT_HEIGHT].copy())
+    return total_duration, total_frames
+
+def render_session_video(session_id, kind, fps, render, size=None, timings=None):
+    timings = timings or StageTimer(kind)
+    os.makedirs(VIDEO_DIR, exist_ok=True)
+    out_path = os.path.join(VIDEO_DIR, f'session_{session_id}_{kind}.mp4')
+    partial_path = os.path.join(VIDEO_DIR, f'session_{session_id}_{kind}.partial.mp4')
+    sampler = FrameSampler(SPRITE_FRAMES, POSTER_WIDTH)
+    sink = VideoSink(partial_path, fps, size, sampler)
+    try:
+        total_duration, total_frames = render(sink)
+        # ffmpeg finishes writing (and moves the index to the front) on close
+        with timings.stage('finalize'):
+            sink.close()
+    except Exception:
+        with contextlib.suppress(Exception):
+            sink.close()
+        remove_file(partial_path)
+        raise
+    if not os.path.exists(partial_path) or os.path.getsize(partial_path) == 0:
+        remove_file(partial_path)
+        raise Exception("Video file was not created or is empty")
+    os.replace(partial_path, out_path)
+    # Written before the video is registered, so the dashboard never lists it without them
+    with timings.stage('thumbnails'):
+        try:
+            write_thumbnails(session_id, sampler)
+        except Exception:
+            app.logger.exception('Failed to write thumbnails for session %s', session_id)
+    video = register_video(session_id, os.path.basename(out_path), sink.codec, total_frames / fps)
+    return {
+        'status': 'video_generated',
+        'session_id': session_id,
+        'video_path': video.url,
+        'type': kind,
+        'frames': total_frames,
+        'width': sink.size[0],
+        'height': sink.size[1],
+        'fps': fps,
+        'video_duration_seconds': total_frames / fps,
+        'session_duration_seconds': total_duration
+    }
+
+def render_session(session_id, mode, progress=None, settings=None, profile=False):
+    if profile:
+        profiler = cProfile.Profile()
+        result = profiler.runcall(render_session, session_id, mode, progress, settings)
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f'render_{session_id}_{mode}_{time.strftime("%Y%m%d-%H%M%S")}.prof')
+        profiler.dump_stats(path)
+        result['profile_path'] = path
+        return result
+    if mode not in RENDER_MODES:
+        raise ValueError(f'Unknown render mode: {mode}')
+    start = time.perf_counter()
+    timings = StageTimer(mode)
+    settings = settings or render_settings()
+    session = db.session.get(Session, session_id)
+    if session is None:
+        raise LookupError(f'Session {session_id} not found')
+    with timings.stage('load_events'):
+        events = load_session_events(session.id)
+    if not events:
+        raise ValueError('No events found for this session')
+    fps = settings['fps']
+    idle_gap = settings['idle_gap']
+    if mode == 'composite':
+        with timings.stage('page_capture'):
+            page = capture_full_page(session)
+        render = lambda sink: composite_session(page, events, sink, fps, progress, idle_gap, timings)
+    else:
+        render = lambda sink: capture_real_browser(session, events, sink, fps, progress, idle_gap, timings)
+    result = render_session_video(session_id, mode, fps, render, (settings['width'], settings['height']), timings)
+    render_seconds = time.perf_counter() - start
+    metrics.observe('mouseflow_render_seconds', render_seconds, mode=mode)
+    metrics.inc('mouseflow_render_frames_total', result['frames'], mode=mode)
+    result['preset'] = settings['preset']
+    result['idle_gap'] = idle_gap
+    result['render_seconds'] = round(render_seconds, 3)
+    result['timings'] = timings.summary()
+    return result
+
+# Job rows live in the database, so any server worker can answer /jobs/<id> and coalesce requests
+class RenderJob(db.Model):
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    session_id = db.Column(db.Integer, nullable=False, index=True)
+    mode = db.Column(db.String(16), nullable=False)
+    settings_json = db.Column(db.Text, nullable=False)
+    profile = db.Column(db.Boolean, nullable=False, default=False)
+    state = db.Column(db.String(16), nullable=False, default='queued')
+    frames_rendered = db.Column(db.Integer, nullable=False, default=0)
+    total_frames = db.Column(db.Integer, nullable=True)
+    # Epoch seconds; heartbeat_at is refreshed by the process that holds the job while it is queued or running
+    created_at = db.Column(db.Float, nullable=False, default=time.time)
+    started_at = db.Column(db.Float, nullable=True)
+    finished_at = db.Column(db.Float, nullable=True, index=True)
+    heartbeat_at = db.Column(db.Float, nullable=False, default=time.time)
+    result_json = db.Column(db.Text, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+
+    @property
+    def settings(self):
+        return json.loads(self.settings_json)
+
+    @property
+    def result(self):
+        return json.loads(self.result_json) if self.result_json else None
+
+    @property
+    def stale(self):
+        # The worker process holding it exited or was killed mid-render
+        return self.state in RENDER_JOB_ACTIVE and self.heartbeat_at < time.time() - RENDER_JOB_STALE
+
+    def same_render(self, mode, settings, profile):
+        return (self.mode, self.settings, self.profile) == (mode, settings, profile)
+
+    def to_dict(self):
+        state, error = ('failed', RENDER_JOB_LOST) if self.stale else (self.state, self.error)
+        settings = self.settings
+        progress = None
+        eta_seconds = None
+        if state == 'done':
+            progress = 1.0
+        elif self.total_frames:
+            progress = round(self.frames_rendered / self.total_frames, 4)
+            if self.frames_rendered and self.started_at and state == 'running':
+                elapsed = time.time() - self.started_at
+                eta_seconds = round(elapsed / self.frames_rendered * (self.total_frames - self.frames_rendered), 1)
+        return {
+            'job_id': self.id,
+            'session_id': self.session_id,
+            'mode': self.mode,
+            'preset': settings['preset'],
+            'settings': settings,
+            'state': state,
+            'progress': progress,
+            'frames_rendered': self.frames_rendered,
+            'total_frames': self.total_frames,
+            'eta_seconds': eta_seconds,
+            'result': self.result,
+            'error': error
+        }
+
+RENDER_JOB_ACTIVE = ('queued', 'running')
+RENDER_JOB_LOST = 'The worker rendering this job exited'
+
+class RenderQueue:
+    def __init__(self, workers):
+        self.workers = workers
+        self.queue = queue.Queue()
+        # Ids of the jobs queued or running in this process, kept alive by the heartbeat thread
+        self.owned = set()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.heartbeat_thread = None
+
+    def submit(self, session_id, mode, settings, profile=False):
+        # Serialises submissions across worker processes, so a session never gets two active jobs
+        lock_for_write(RENDER_LOCK_KEY)
+        self.prune()
+        job = RenderJob.query.filter(RenderJob.session_id == session_id,
+                                     RenderJob.state.in_(RENDER_JOB_ACTIVE)).first()
+        if job is not None:
+            db.session.commit()
+            return job, False
+        job = RenderJob(session_id=session_id, mode=mode, settings_json=json.dumps(settings), profile=profile)
+        db.session.add(job)
+        db.session.commit()
+        with self.lock:
+            self.owned.add(job.id)
+            self.start()
+        self.queue.put((job.id, session_id, mode, settings, profile))
+        return job, True
+
+    def get(self, job_id):
+        return db.session.get(RenderJob, job_id)
+
+    def prune(self):
+        now = time.time()
+        RenderJob.query.filter(RenderJob.state.in_(RENDER_JOB_ACTIVE),
+                               RenderJob.heartbeat_at < now - RENDER_JOB_STALE).update(
+            {'state': 'failed', 'error': RENDER_JOB_LOST, 'finished_at': now}, synchronize_session=False)
+        RenderJob.query.filter(RenderJob.finished_at < now - RENDER_JOB_TTL).delete(synchronize_session=False)
+
+    def start(self):
+        if CHROME_WARM:
+            chrome_pool.start_warming()
+        self.threads = [t for t in self.threads if t.is_alive()]
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self.run, name=f'mouseflow-render-{len(self.threads)}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        if self.heartbeat_thread is None or not self.heartbeat_thread.is_alive():
+            self.heartbeat_thread = threading.Thread(target=self.heartbeat, name='mouseflow-render-heartbeat',
+                                                     daemon=True)
+            self.heartbeat_thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                self.execute(*item)
+            finally:
+                self.queue.task_done()
+
+    def heartbeat(self):
+        while True:
+            time.sleep(RENDER_JOB_HEARTBEAT)
+            with self.lock:
+                job_ids = list(self.owned)
+            if job_ids:
+                self.store(RenderJob.id.in_(job_ids), heartbeat_at=time.time())
+
+    def store(self, where, attempts=1, **values):
+        # A core connection of its own: committing the render thread's ORM session would expire the events it loaded
+        for attempt in range(attempts):
+            try:
+                with app.app_context(), db.engine.begin() as connection:
+                    connection.execute(RenderJob.__table__.update().where(where).values(**values))
+                return
+            except OperationalError:
+                if attempt == attempts - 1:
+                    app.logger.exception('Could not update render jobs')
+                else:
+                    time.sleep(INGEST_RETRY_DELAY * 2 ** attempt)
+
+    def execute(self, job_id, session_id, mode, settings, profile):
+        where = RenderJob.id == job_id
+        last_update = 0.0
+
+        def update(frames_rendered, total_frames):
+            # Progress is only for display, so skip a write rather than slow the render down
+            nonlocal last_update
+            now = time.monotonic()
+            if now - last_update >= RENDER_PROGRESS_INTERVAL or frames_rendered == total_frames:
+                last_update = now
+                self.store(where, frames_rendered=frames_rendered, total_frames=total_frames)
+
+        self.store(where, state='running', started_at=time.time())
+        state, result, error = 'failed', None, None
+        try:
+            with app.app_context():
+                result = render_session(session_id, mode, update, settings, profile)
+            state = 'done'
+        except Exception as e:
+            error = str(e)
+            app.logger.exception('Render job %s for session %s failed', job_id, session_id)
+        finally:
+            self.store(where, INGEST_WRITE_RETRIES, state=state, error=error, finished_at=time.time(),
+                       result_json=json.dumps(result) if result is not None else None)
+            metrics.inc('mouseflow_renders_total', mode=mode, state=state)
+            with self.lock:
+                self.owned.discard(job_id)
+
+render_queue = RenderQueue(RENDER_WORKERS)
+
+metrics.gauge('mouseflow_ingest_queue_depth', 'Payloads waiting for the ingest writer.',
+              lambda: ingest_writer.queue.qsize())
+metrics.gauge('mouseflow_render_queue_depth', 'Render jobs waiting for a render thread.',
+              lambda: render_queue.queue.qsize())
+metrics.gauge('mouseflow_renders_active', 'Render jobs queued or running in this process.',
+              lambda: len(render_queue.owned))
+metrics.gauge('mouseflow_chrome_idle', 'Warm Chrome instances waiting in the pool.', lambda: chrome_pool.idle.qsize())
+
+def enqueue_render(session_id, mode):
+    Session.query.get_or_404(session_id)
+    if (db.session.query(Event.id).filter_by(session_id=session_id).first() is None
+            and db.session.query(MoveChunk.id).filter_by(session_id=session_id).first() is None):
+        return jsonify({'status': 'error', 'message': 'No events found for this session'}), 400
+    try:
+        settings = render_settings(
+            request.args.get('preset', DEFAULT_RENDER_PRESET),
+            fps=request.args.get('fps', type=int),
+            width=request.args.get('width', type=int),
+            idle_gap=request.args.get('idle_gap', type=float))
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    profile = request.args.get('profile', '').lower() in ('1', 'true', 'yes')
+    job, created = render_queue.submit(session_id, mode, settings, profile)
+    # Renders of one session share their output files, so only an identical request may join the running job
+    if not created and not job.same_render(mode, settings, profile):
+        response = job.to_dict()
+        response['status'] = 'error'
+        response['message'] = f'Session {session_id} is already being rendered with other settings'
+        response['job_url'] = url_for('get_job', job_id=job.id)
+        return jsonify(response), 409
+    response = job.to_dict()
+    response['status'] = job.state
+    response['coalesced'] = not created
+    response['job_url'] = url_for('get_job', job_id=job.id)
+    return jsonify(response), 202
+
+@app.route('/generate_real_browser_video/<int:session_id>', methods=['POST'])
+def generate_real_browser_video(session_id):
+    return enqueue_render(session_id, 'real_browser')
+
+@app.route('/generate_composite_video/<int:session_id>', methods=['POST'])
+def generate_composite_video(session_id):
+    return enqueue_render(session_id, 'composite')
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = render_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
+def video_is_current(session, mode):
+    video = session.video
+    if video is None or not video.filename.endswith(f'_{mode}.mp4') or not os.path.exists(video.path):
+        return False
+    return video.generated_at >= (session.last_seen or session.timestamp)
+
+def render_worker_init():
+    global chrome_pool
+    # Connections and Chrome instances must not be shared with the parent process
+    with app.app_context():
+        db.engine.dispose(close=False)
+    chrome_pool = ChromePool(1, CHROME_MAX_JOBS)
+    multiprocessing.util.Finalize(None, chrome_pool.close, exitpriority=10)
+    # Each process renders one session at a time, so OpenCV's own threads would only oversubscribe the cores
+    cv2.setNumThreads(1)
+
+def render_worker(session_id, mode, settings, profile):
+    with app.app_context():
+        return render_session(session_id, mode, settings=settings, profile=profile)
+
+@app.cli.command('render-videos')
+@click.argument('session_ids', nargs=-1, type=int)
+@click.option('--since', type=click.DateTime(), help='Only sessions started at or after this time.')
+@click.option('--until', type=click.DateTime(), help='Only sessions started before this time.')
+@click.option('--missing', is_flag=True, help='Every session without an up-to-date video.')
+@click.option('--mode', type=click.Choice(RENDER_MODES), default='composite', show_default=True)
+@click.option('--preset', type=click.Choice(list(RENDER_PRESETS)), default=DEFAULT_RENDER_PRESET, show_default=True)
+@click.option('--workers', type=int, default=os.cpu_count() or 1, show_default=True, help='Render processes.')
+@click.option('--force', is_flag=True, help='Re-render sessions whose video is already up to date.')
+@click.option('--profile', is_flag=True, help=f'Write a cProfile dump per session to {PROFILE_DIR}.')
+def render_videos(session_ids, since, until, missing, mode, preset, workers, force, profile):
+    """Render session videos in parallel worker processes."""
+    if not (session_ids or since or until or missing):
+        raise click.UsageError('Pass session ids, --since/--until or --missing.')
+    settings = render_settings(preset)
+    query = Session.query.filter(or_(Session.events.any(), Session.move_chunks.any()))
+    if session_ids:
+        query = query.filter(Session.id.in_(session_ids))
+    if since:
+        query = query.filter(Session.timestamp >= since)
+    if until:
+        query = query.filter(Session.timestamp < until)
+    sessions = query.order_by(Session.id).all()
+    todo = [s.id for s in sessions if force or not video_is_current(s, mode)]
+    skipped = len(sessions) - len(todo)
+    db.session.remove()
+    if not todo:
+        print(f'Nothing to render ({skipped} sessions already up to date).')
+        return
+    workers = max(1, min(workers, len(todo)))
+    print(f'Rendering {len(todo)} sessions in {mode} mode ({preset} preset) with {workers} workers'
+          f' ({skipped} already up to date).')
+    start = time.perf_counter()
+    rendered = failed = frames = 0
+    stage_ms = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=render_worker_init) as pool:
+        futures = {pool.submit(render_worker, session_id, mode, settings, profile): session_id for session_id in todo}
+        for future in concurrent.futures.as_completed(futures):
+            session_id = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                failed += 1
+                print(f'  session {session_id}: failed: {e}')
+                continue
+            rendered += 1
+            frames += result['frames']
+            for stage, timing in result['timings'].items():
+                stage_ms[stage] = stage_ms.get(stage, 0) + timing['total_ms']
+            print(f"  session {session_id}: {result['frames']} frames in {result['render_seconds']:.1f}s"
+                  f" -> {result['video_path']}" + (f" (profile: {result['profile_path']})" if profile else ''))
+    elapsed = time.perf_counter() - start
+    print(f'Rendered {rendered}, failed {failed}, skipped {skipped} in {elapsed:.1f}s:'
+          f' {rendered / elapsed * 60:.1f} sessions/min, {frames / elapsed:.1f} frames/s.')
+    if stage_ms:
+        total_ms = sum(stage_ms.values())
+        print('Time by stage: ' + ', '.join(f'{stage} {ms / total_ms:.0%}' for stage, ms in
+                                             sorted(stage_ms.items(), key=lambda item: -item[1])))
+    if failed:
+        raise SystemExit(1)
+
+def create_missing_indexes():
+    # create_all() only indexes the tables it creates, so databases from before an index was added get it here
+    inspector = sqla_inspect(db.engine)
+    created = []
+    for table in db.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            missing = [column.name for column in index.columns if column.name not in columns]
+            if missing:
+                print(f'Skipping index {index.name}: {table.name} is missing {", ".join(missing)} '
+                      f'(the table predates them; see /recreate_db).')
+            elif index.name not in existing:
+                print(f'Creating index {index.name} on {table.name}...')
+                index.create(db.engine)
+                created.append(index.name)
+    return created
+
+@app.cli.command('init-db')
+def init_db():
+    """Create any missing tables and indexes; run once before starting several server workers."""
+    db.create_all()
+    created = create_missing_indexes()
+    print(f'Tables ready in {db.engine.url.render_as_string(hide_password=True)}, {len(created)} indexes created.')
 
 @app.route('/recreate_db')
 def recreate_db():
@@ -515,4 +3107,8 @@ if __name__ == '__main__':
     os.makedirs('static/videos', exist_ok=True)
     with app.app_context():
         db.create_all()
+    app.logger.info('Encoding videos with %s', select_video_encoder())
+    # Only the reloader's serving child should start Chrome
+    if CHROME_WARM and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        chrome_pool.start_warming()
     app.run(debug=True)
@@ -0,0 +1,659 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the Mouse Flow ingest and render paths.
+
+Runs against a throwaway SQLite database, never the real db.sqlite3.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+_tmpdir = tempfile.mkdtemp(prefix='mouseflow_bench_')
+os.environ['MOUSEFLOW_DATABASE_URL'] = 'sqlite:///' + os.path.join(_tmpdir, 'bench.sqlite3')
+# Measure the write path itself rather than the writer thread's coalescing window
+os.environ['MOUSEFLOW_INGEST_ASYNC'] = '0'
+# Chrome launching in the background would skew the timings; renders still launch it when they need it
+os.environ['MOUSEFLOW_CHROME_WARM'] = '0'
+
+import cv2
+import numpy as np
+
+from sqlalchemy import func
+
+from flask import jsonify, send_from_directory
+
+import app as mouseflow
+from app import (app, db, Session, Event, MoveChunk, Video, PKT, VideoSink, session_timeline, timeline_frames, load_session_events,
+                 get_scroll_percentage, bin_points, draw_trail, draw_cursor, draw_cursor_shapes, draw_hud)
+
+
+def make_events(count, start_ms=None):
+    start_ms = start_ms or int(time.time() * 1000)
+    events = []
+    for i in range(count):
+        events.append({
+            'type': 'click' if i % 50 == 0 else 'mousemove',
+            'timestamp': start_ms + i * 16,
+            'x': random.randint(0, 1279),
+            'y': random.randint(0, 719)
+        })
+    return events
+
+
+def legacy_collect(payload):
+    # The pre-bulk /collect body: one ORM object per event
+    session = Session(ip_address='127.0.0.1', user_agent='bench', url=payload['url'])
+    db.session.add(session)
+    db.session.flush()
+    for evt in payload['events']:
+        event = Event(
+            session_id=session.id,
+            event_type=evt['type'],
+            timestamp=datetime.datetime.fromtimestamp(evt['timestamp'] / 1000.0, tz=PKT),
+            x=evt.get('x'),
+            y=evt.get('y'),
+            additional_data=evt.get('data')
+        )
+        db.session.add(event)
+    db.session.commit()
+
+
+def bench_ingest(sizes, repeats):
+    print("Ingest throughput (events/s)")
+    print(f"{'batch':>8} {'legacy ORM':>14} {'bulk /collect':>14} {'speedup':>8}")
+    client = app.test_client()
+    with app.app_context():
+        db.create_all()
+        for size in sizes:
+            payload = {'url': 'https://example.com', 'events': make_events(size)}
+            legacy_time = 0.0
+            bulk_time = 0.0
+            for _ in range(repeats):
+                start = time.perf_counter()
+                legacy_collect(payload)
+                legacy_time += time.perf_counter() - start
+                start = time.perf_counter()
+                response = client.post('/collect', json=payload)
+                bulk_time += time.perf_counter() - start
+                if response.status_code >= 300:
+                    raise RuntimeError(f"/collect returned {response.status_code}: {response.get_data(as_text=True)}")
+            legacy_rate = size * repeats / legacy_time
+            bulk_rate = size * repeats / bulk_time
+            print(f"{size:>8} {legacy_rate:>14,.0f} {bulk_rate:>14,.0f} {bulk_rate / legacy_rate:>7.1f}x")
+
+
+def bench_memory(frame_counts, tolerance):
+    print("Peak traced memory while encoding 1280x720 frames")
+    peaks = []
+    for count in frame_counts:
+        sink = VideoSink(os.path.join(_tmpdir, f'memory_{count}.mp4'), 15)
+        tracemalloc.start()
+        start = time.perf_counter()
+        for i in range(count):
+            frame = np.full((720, 1280, 3), i % 255, dtype=np.uint8)
+            sink.write(frame)
+        sink.close()
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        peaks.append(peak)
+        print(f"{count:>6} frames: peak {peak / 2**20:8.1f} MiB, {count / elapsed:6.1f} frames/s")
+    growth = peaks[-1] / peaks[0]
+    if growth > tolerance:
+        print(f"FAIL: peak memory grew {growth:.2f}x from {frame_counts[0]} to {frame_counts[-1]} frames")
+        return False
+    print(f"OK: peak memory grew {growth:.2f}x (limit {tolerance}x)")
+    return True
+
+
+def legacy_event_at(event_timeline, current_time):
+    # The pre-searchsorted frame lookup: scan the timeline from the start every frame
+    current_event = None
+    current_event_idx = -1
+    for event_time, evt, evt_idx in event_timeline:
+        if event_time <= current_time:
+            current_event = evt
+            current_event_idx = evt_idx
+        else:
+            break
+    return current_event, current_event_idx
+
+
+def bench_timeline(sizes, fps, sample_frames):
+    print(f"Frame -> event lookup at {fps} fps")
+    print(f"{'events':>8} {'frames':>8} {'legacy scan':>14} {'searchsorted':>14} {'speedup':>9}")
+    for size in sizes:
+        start_time = datetime.datetime(2024, 1, 1, tzinfo=PKT)
+        events = [SimpleNamespace(timestamp=start_time + datetime.timedelta(milliseconds=i * 16 + random.randint(0, 15)),
+                                  event_type='click' if i % 50 == 0 else 'mousemove')
+                  for i in range(size)]
+        start = time.perf_counter()
+        total_duration, total_frames, frame_events, frame_times, frame_skips = session_timeline(events, fps)
+        skipped_clicks = 0
+        for _, _, _, _, skipped, _ in timeline_frames(events, frame_events, frame_times, frame_skips):
+            skipped_clicks += sum(1 for evt in skipped if evt.event_type == 'click')
+        new_time = time.perf_counter() - start
+        # The legacy scan is quadratic, so time an evenly spaced sample of frames and scale up
+        event_timeline = [((evt.timestamp - events[0].timestamp).total_seconds(), evt, i) for i, evt in enumerate(events)]
+        step = max(1, total_frames // sample_frames)
+        start = time.perf_counter()
+        for frame_idx in range(0, total_frames, step):
+            _, legacy_idx = legacy_event_at(event_timeline, frame_idx * (1.0 / fps))
+            if legacy_idx != frame_events[frame_idx]:
+                raise RuntimeError(f"Lookup mismatch at frame {frame_idx}: {legacy_idx} != {frame_events[frame_idx]}")
+        legacy_time = (time.perf_counter() - start) * step
+        print(f"{size:>8} {total_frames:>8} {legacy_time:>13.3f}s {new_time:>13.3f}s {legacy_time / new_time:>8.0f}x"
+              f"  ({skipped_clicks} clicks between frames kept)")
+
+
+def database_bytes():
+    with db.engine.connect() as connection:
+        connection.exec_driver_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+        page_count = connection.exec_driver_sql('PRAGMA page_count').scalar()
+        page_size = connection.exec_driver_sql('PRAGMA page_size').scalar()
+    return page_count * page_size
+
+
+def bench_storage(points, batch):
+    print(f"Mousemove storage for a {points}-point session in batches of {batch}")
+    print(f"{'mode':>8} {'bytes/point':>12} {'ingest':>10} {'load':>10}")
+    client = app.test_client()
+    with app.app_context():
+        db.create_all()
+        for mode in ['rows', 'packed']:
+            mouseflow.MOVE_STORAGE = mode
+            events = make_events(points)
+            for evt in events:
+                evt['type'] = 'mousemove'
+            size_before = database_bytes()
+            start = time.perf_counter()
+            for i in range(0, points, batch):
+                client.post('/collect', json={'url': 'https://example.com', 'session_token': mode, 'events': events[i:i + batch]})
+            ingest_time = time.perf_counter() - start
+            size = database_bytes() - size_before
+            session_id = Session.query.filter_by(token=mode).one().id
+            db.session.expire_all()
+            start = time.perf_counter()
+            loaded = load_session_events(session_id)
+            len(loaded)
+            load_time = time.perf_counter() - start
+            # Drop the loaded rows so later commits don't have to expire them
+            db.session.remove()
+            print(f"{mode:>8} {size / points:>12.1f} {ingest_time:>9.3f}s {load_time:>9.3f}s")
+
+
+def legacy_session_response(session_id):
+    # The pre-streaming GET /session/<id>: every event loaded and serialized at once
+    session = db.session.get(Session, session_id)
+    return jsonify({
+        'session_id': session.id,
+        'ip_address': session.ip_address,
+        'timestamp': session.timestamp.isoformat(),
+        'user_agent': session.user_agent,
+        'events': [{
+            'type': e.event_type,
+            'timestamp': e.timestamp.isoformat(),
+            'x': e.x,
+            'y': e.y,
+            'data': get_scroll_percentage(e.additional_data) if e.event_type == 'scroll' else e.additional_data
+        } for e in load_session_events(session.id)]
+    }).get_data()
+
+
+def read_session_response(client, session_id, name):
+    start = time.perf_counter()
+    if name == 'legacy':
+        body = iter([legacy_session_response(session_id)])
+    else:
+        body = client.get(f'/session/{session_id}?format={name}', buffered=False).response
+    first_byte = None
+    for _ in body:
+        if first_byte is None:
+            first_byte = time.perf_counter() - start
+    total = time.perf_counter() - start
+    db.session.remove()
+    return first_byte, total
+
+
+def bench_stream(points, batch):
+    print(f"GET /session/<id> for a {points}-event session")
+    print(f"{'response':>10} {'first byte':>11} {'total':>9} {'peak memory':>12}")
+    client = app.test_client()
+    with app.app_context():
+        db.create_all()
+        events = make_events(points)
+        for i in range(0, points, batch):
+            client.post('/collect', json={'url': 'https://example.com', 'session_token': 'stream', 'events': events[i:i + batch]})
+        session_id = Session.query.filter_by(token='stream').one().id
+        db.session.remove()
+        for name in ['legacy', 'json', 'ndjson']:
+            # Timed without tracemalloc, whose overhead would swamp the per-event cost
+            first_byte, total = read_session_response(client, session_id, name)
+            tracemalloc.start()
+            read_session_response(client, session_id, name)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"{name:>10} {first_byte:>10.3f}s {total:>8.3f}s {peak / 2**20:>8.1f} MiB")
+
+def legacy_heatmap(url):
+    # The offline aggregation the heatmap routes replace: load every session for the URL and bin its events
+    xs, ys = [], []
+    for session in Session.query.filter_by(url=url):
+        for evt in load_session_events(session.id):
+            if evt.event_type == 'mousemove':
+                xs.append(evt.x)
+                ys.append(evt.y)
+    return bin_points(xs, ys)
+
+
+def bench_heatmap(sessions, points, batch):
+    print(f"Mousemove heatmap for one URL over {sessions} sessions x {points} events")
+    client = app.test_client()
+    with app.app_context():
+        db.create_all()
+        url = 'https://example.com/heatmap'
+        start = time.perf_counter()
+        for n in range(sessions):
+            events = make_events(points)
+            for i in range(0, points, batch):
+                client.post('/collect', json={'url': url, 'session_token': f'heatmap-{n}', 'events': events[i:i + batch]})
+        print(f"  ingest (with incremental heatmap): {time.perf_counter() - start:8.3f}s")
+        db.session.remove()
+        start = time.perf_counter()
+        expected = legacy_heatmap(url)
+        print(f"  load and bin every session:        {time.perf_counter() - start:8.3f}s")
+        db.session.remove()
+        start = time.perf_counter()
+        response = client.get('/heatmap', query_string={'url': url})
+        print(f"  GET /heatmap:                      {time.perf_counter() - start:8.3f}s")
+        if response.json['counts'] != expected.tolist():
+            raise RuntimeError("GET /heatmap does not match the offline aggregation")
+        start = time.perf_counter()
+        client.get('/heatmap.png', query_string={'url': url})
+        print(f"  GET /heatmap.png:                  {time.perf_counter() - start:8.3f}s")
+
+
+def legacy_draw_trail(frame, mouse_trail, page_width, page_height):
+    # The pre-polyline trail: one filled circle per point
+    for j, (trail_x, trail_y, trail_type) in enumerate(mouse_trail[:-1]):
+        if 0 <= trail_x < page_width and 0 <= trail_y < page_height:
+            alpha = max(0.1, (1.0 - j / len(mouse_trail)) * 0.8)
+            if trail_type == 'click':
+                color, radius = (int(255 * alpha), int(100 * alpha), int(100 * alpha)), int(3 + 2 * alpha)
+            elif trail_type == 'scroll':
+                color, radius = (int(100 * alpha), int(100 * alpha), int(255 * alpha)), int(2 + 2 * alpha)
+            else:
+                color, radius = (int(100 * alpha), int(255 * alpha), int(100 * alpha)), int(2 + 1 * alpha)
+            cv2.circle(frame, (trail_x, trail_y), radius, color, -1)
+
+
+def legacy_draw_hud(frame, current_time, total_duration, current_event, current_event_idx, event_count):
+    # The pre-ROI HUD: blend a copy of the whole frame to darken one rectangle
+    overlay = frame.copy()
+    cv2.rectangle(overlay, (10, 10), (450, 100), (0, 0, 0), -1)
+    cv2.addWeighted(overlay, 0.3, frame, 0.7, 0, frame)
+    cv2.putText(frame, f"Session Time: {current_time:.1f}s / {total_duration:.1f}s",
+                (15, 35), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
+    cv2.putText(frame, f"Event {current_event_idx + 1}/{event_count}: {current_event.event_type}",
+                (15, 60), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
+    cv2.putText(frame, f"Event Time: {current_event.timestamp.strftime('%H:%M:%S.%f')[:-3]}",
+                (15, 85), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+    cv2.putText(frame, f"Position: ({current_event.x}, {current_event.y})",
+                (15, 105), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1)
+
+
+def bench_overlay(frames, trail_length):
+    print(f"Overlay cost per 1280x720 frame, {trail_length}-point trail, {frames} frames")
+    page = np.random.default_rng(0).integers(0, 256, (720, 1280, 3), dtype=np.uint8)
+    types = ['mousemove'] * 8 + ['click', 'scroll']
+    # A random walk, like consecutive mousemoves
+    walk = [(640, 360)]
+    for _ in range(frames + trail_length):
+        x, y = walk[-1]
+        walk.append((min(max(x + random.randint(-25, 25), 0), 1279), min(max(y + random.randint(-25, 25), 0), 719)))
+    points = [(x, y, random.choice(types)) for x, y in walk]
+    trails = [points[i:i + trail_length] for i in range(frames)]
+    evt = SimpleNamespace(event_type='mousemove', timestamp=datetime.datetime(2024, 1, 1, tzinfo=PKT), x=640, y=360)
+    stages = {
+        'trail': (lambda f, t: legacy_draw_trail(f, t, 1280, 720), lambda f, t: draw_trail(f, t, 1280, 720)),
+        'cursor': (lambda f, t: draw_cursor_shapes(f, t[-1][0], t[-1][1], t[-1][2]),
+                   lambda f, t: draw_cursor(f, t[-1][0], t[-1][1], t[-1][2])),
+        'hud': (lambda f, t: legacy_draw_hud(f, 1.0, 10.0, evt, 0, 100), lambda f, t: draw_hud(f, 1.0, 10.0, evt, 0, 100)),
+    }
+    print(f"{'stage':>8} {'before':>10} {'after':>10} {'speedup':>8}")
+    totals = [0.0, 0.0]
+    for name, variants in stages.items():
+        times = []
+        for draw in variants:
+            frame = page.copy()
+            start = time.perf_counter()
+            for trail in trails:
+                draw(frame, trail)
+            times.append((time.perf_counter() - start) / frames)
+        totals = [total + t for total, t in zip(totals, times)]
+        print(f"{name:>8} {times[0] * 1e6:>8.0f}us {times[1] * 1e6:>8.0f}us {times[0] / times[1]:>7.1f}x")
+    print(f"{'total':>8} {totals[0] * 1e6:>8.0f}us {totals[1] * 1e6:>8.0f}us {totals[0] / totals[1]:>7.1f}x")
+
+
+def bench_encoder(frames, fps):
+    print(f"Encoding {frames} 1280x720 frames at {fps} fps")
+    print(f"{'encoder':>8} {'codec':>6} {'frames/s':>9} {'size':>10}")
+    page = np.full((720, 1280, 3), 235, dtype=np.uint8)
+    cv2.putText(page, 'Mouse Flow', (100, 200), cv2.FONT_HERSHEY_SIMPLEX, 3, (40, 40, 40), 5)
+    encoders = ['opencv'] + (['ffmpeg'] if mouseflow.select_video_encoder() == 'ffmpeg' else [])
+    for encoder in encoders:
+        mouseflow._video_encoder = encoder
+        path = os.path.join(_tmpdir, f'encoder_{encoder}.mp4')
+        sink = VideoSink(path, fps)
+        start = time.perf_counter()
+        for i in range(frames):
+            frame = page.copy()
+            draw_cursor(frame, 200 + i % 800, 300 + (i // 4) % 300, 'mousemove')
+            sink.write(frame)
+        sink.close()
+        elapsed = time.perf_counter() - start
+        print(f"{encoder:>8} {sink.codec:>6} {frames / elapsed:>9.1f} {os.path.getsize(path) / 1024:>7.0f} KiB")
+    if len(encoders) == 1:
+        print("(ffmpeg with libx264 not found; set MOUSEFLOW_FFMPEG to compare)")
+
+
+def seed_old_sessions(sessions, points, age_days):
+    start = datetime.datetime.now(PKT).replace(tzinfo=None) - datetime.timedelta(days=age_days)
+    ids = []
+    for n in range(sessions):
+        session = Session(url='https://example.com/old', timestamp=start, last_seen=start)
+        db.session.add(session)
+        db.session.flush()
+        mouseflow.insert_events(session.id, [
+            {'event_type': 'mousemove', 'timestamp': start + datetime.timedelta(milliseconds=16 * i),
+             'x': random.randint(0, 1279), 'y': random.randint(0, 719), 'additional_data': None}
+            for i in range(points)])
+        ids.append(session.id)
+    db.session.commit()
+    return ids
+
+
+def bench_retention(sessions, points, batch):
+    print(f"Retention over {sessions} sessions x {points} mousemove rows")
+    mouseflow.ARCHIVE_DIR = os.path.join(_tmpdir, 'archive')
+    mouseflow.MOVE_STORAGE = 'rows'
+    with app.app_context():
+        db.create_all()
+        ids = seed_old_sessions(sessions, points, 100)
+        start = time.perf_counter()
+        mouseflow.purge_sessions(ids)
+        print(f"  delete in one transaction:  longest write {time.perf_counter() - start:8.3f}s")
+        ids = seed_old_sessions(sessions, points, 100)
+        longest = archive_time = 0
+        for i in range(0, len(ids), batch):
+            batch_ids = ids[i:i + batch]
+            # Writing the archive only reads, which WAL lets run alongside /collect
+            start = time.perf_counter()
+            mouseflow.write_archive(Session.query.filter(Session.id.in_(batch_ids)).all())
+            archive_time += time.perf_counter() - start
+            start = time.perf_counter()
+            mouseflow.purge_sessions(batch_ids)
+            longest = max(longest, time.perf_counter() - start)
+        print(f"  delete in batches of {batch:<5} longest write {longest:8.3f}s "
+              f"(archive written at {sessions * points / archive_time:,.0f} events/s)")
+        ids = seed_old_sessions(sessions, points, 30)
+        start = time.perf_counter()
+        before = after = 0
+        for session_id in ids:
+            counts = mouseflow.downsample_session_moves(session_id, mouseflow.RETENTION_DOWNSAMPLE_MS)
+            before += counts[0]
+            after += counts[1]
+        db.session.commit()
+        print(f"  downsample to one point per {mouseflow.RETENTION_DOWNSAMPLE_MS} ms: {before} -> {after} rows "
+              f"in {time.perf_counter() - start:.3f}s")
+
+
+def start_server(workers, threads, async_ingest):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    env = dict(os.environ, MOUSEFLOW_INGEST_ASYNC='1' if async_ingest else '0')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--preload', '--workers', str(workers), '--threads', str(threads),
+         '--bind', f'127.0.0.1:{port}', '--log-level', 'warning', 'app:app'],
+        cwd=os.path.dirname(os.path.abspath(mouseflow.__file__)), env=env)
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, f'http://127.0.0.1:{port}'
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError("gunicorn did not start; is it installed?")
+            time.sleep(0.2)
+
+
+def post_collect(url, body):
+    request = urllib.request.Request(url + '/collect', data=body, headers={'Content-Type': 'application/json'})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=60) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except OSError:
+        status = 'error'
+    return status, time.perf_counter() - start
+
+
+def bench_load(workers, threads, concurrency, requests, events, sessions, async_ingest):
+    mode = 'async' if async_ingest else 'sync'
+    print(f"{requests} POST /collect x {events} events from {concurrency} clients, "
+          f"gunicorn {workers} workers x {threads} threads, {mode} ingest")
+    with app.app_context():
+        db.create_all()
+    bodies = [json.dumps({'url': 'https://example.com/load', 'session_token': f'load-{i % sessions}',
+                                    'events': make_events(events, 1700000000000 + i * events * 16)}).encode()
+              for i in range(requests)]
+    process, url = start_server(workers, threads, async_ingest)
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            results = list(pool.map(lambda body: post_collect(url, body), bodies))
+        elapsed = time.perf_counter() - start
+    finally:
+        # A graceful stop lets each worker's ingest writer drain its queue
+        process.terminate()
+        process.wait(timeout=60)
+    latencies = np.array([latency for _, latency in results]) * 1000
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    print(f"  {requests / elapsed:8.1f} req/s  {requests * events / elapsed:10.0f} events/s")
+    print(f"  latency p50 {p50:.1f} ms  p90 {p90:.1f} ms  p99 {p99:.1f} ms  max {latencies.max():.1f} ms")
+    print("  status " + "  ".join(f"{status}: {count}" for status, count in sorted(statuses.items(), key=str)))
+    with app.app_context():
+        stored = (db.session.query(func.count(Event.id)).scalar()
+                  + (db.session.query(func.sum(MoveChunk.count)).scalar() or 0))
+        session_count = Session.query.count()
+    accepted = sum(count for status, count in statuses.items() if status in (200, 202)) * events
+    print(f"  stored {stored} of {accepted} accepted events in {session_count} sessions (expected {sessions})")
+    return stored == accepted and session_count == sessions
+
+CAPTURE_PAGE = ('data:text/html,<body style="margin:0;height:4000px;'
+                'background:linear-gradient(%23fff,%2336c)"><h1>Mouse Flow</h1></body>')
+
+
+def bench_capture(seconds, fps):
+    print(f"Real-browser capture of a {seconds}s session at {fps} fps")
+    with app.app_context():
+        db.create_all()
+        start = datetime.datetime.now(PKT).replace(tzinfo=None)
+        session = Session(url=CAPTURE_PAGE, timestamp=start, last_seen=start)
+        db.session.add(session)
+        db.session.flush()
+        count = seconds * 60
+        mouseflow.insert_events(session.id, [
+            {'event_type': 'scroll' if i % 30 == 29 else 'click' if i % 50 == 0 else 'mousemove',
+             'timestamp': start + datetime.timedelta(milliseconds=16 * i),
+             'x': 0 if i % 30 == 29 else random.randint(0, 1279),
+             'y': min(100, i * 100 / count) if i % 30 == 29 else random.randint(0, 719),
+             'additional_data': None}
+            for i in range(count)])
+        db.session.commit()
+        events = load_session_events(session.id)
+        print(f"{'backend':>10} {'frames':>7} {'frames/s':>9}  slowest stages")
+        for backend in mouseflow.CAPTURE_BACKENDS:
+            sink = VideoSink(os.path.join(_tmpdir, f'capture_{backend}.mp4'), fps)
+            timings = mouseflow.StageTimer('real_browser')
+            try:
+                started = time.perf_counter()
+                mouseflow.capture_real_browser(session, events, sink, fps, timings=timings, backend=backend)
+                elapsed = time.perf_counter() - started
+            except Exception as e:
+                print(f"Chrome is not available, skipping ({type(e).__name__}: {e})")
+                return
+            finally:
+                sink.close()
+            stages = sorted(timings.summary().items(), key=lambda item: -item[1]['total_ms'])[:3]
+            print(f"{backend:>10} {sink.frames_written:>7} {sink.frames_written / elapsed:>9.1f}  "
+                  + ', '.join(f"{name} {stats['total_ms'] / 1000:.1f}s" for name, stats in stages))
+
+
+def legacy_serve_video(session_id):
+    video = Video.query.filter_by(session_id=session_id).first()
+    response = send_from_directory(os.path.abspath(mouseflow.VIDEO_DIR), video.filename)
+    response.headers['Content-Type'] = 'video/mp4'
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Cache-Control'] = 'public, max-age=3600'
+    return response
+
+
+def bench_media(frames, requests):
+    print(f"Serving a {frames}-frame video and its thumbnails, {requests} requests each")
+    mouseflow.VIDEO_DIR = os.path.join(_tmpdir, 'videos')
+    mouseflow.THUMBNAIL_DIR = os.path.join(mouseflow.VIDEO_DIR, 'thumbs')
+    os.makedirs(mouseflow.VIDEO_DIR, exist_ok=True)
+    app.add_url_rule('/legacy_video/<int:session_id>', view_func=legacy_serve_video)
+    page = np.full((720, 1280, 3), 235, dtype=np.uint8)
+    cv2.putText(page, 'Mouse Flow', (100, 200), cv2.FONT_HERSHEY_SIMPLEX, 3, (40, 40, 40), 5)
+    with app.app_context():
+        db.create_all()
+        session = Session(url='https://example.com/media')
+        db.session.add(session)
+        db.session.commit()
+        sampler = mouseflow.FrameSampler(mouseflow.SPRITE_FRAMES, mouseflow.POSTER_WIDTH)
+        sink = VideoSink(os.path.join(mouseflow.VIDEO_DIR, f'session_{session.id}_composite.mp4'), 15, sampler=sampler)
+        start = time.perf_counter()
+        for i in range(frames):
+            frame = page.copy()
+            draw_cursor(frame, 200 + i % 800, 300 + (i // 4) % 300, 'mousemove')
+            sink.write(frame)
+        sink.close()
+        encode_time = time.perf_counter() - start
+        start = time.perf_counter()
+        mouseflow.write_thumbnails(session.id, sampler)
+        thumbnail_time = time.perf_counter() - start
+        video = mouseflow.register_video(session.id, os.path.basename(sink.path), sink.codec, frames / 15)
+        session_id, version, size = session.id, video.version, video.size_bytes
+    print(f"  thumbnails written in {thumbnail_time * 1000:.1f}ms ({thumbnail_time / encode_time:.1%} of encoding)")
+    print(f"  bytes per dashboard row: video {size / 1024:,.0f} KiB, "
+          f"poster {os.path.getsize(mouseflow.poster_path(session_id)) / 1024:.1f} KiB, "
+          f"sprite on hover {os.path.getsize(mouseflow.sprite_path(session_id)) / 1024:.1f} KiB")
+    client = app.test_client()
+    print(f"{'':>10} {'request':>12} {'status':>7} {'ms/request':>11}  cache-control")
+    for name, url in [('legacy', f'/legacy_video/{session_id}'), ('current', f'/video/{session_id}?v={version}')]:
+        etag = client.get(url).headers['ETag']
+        for label, headers in [('full', {}), ('revalidate', {'If-None-Match': etag}), ('range 64KiB', {'Range': 'bytes=0-65535'})]:
+            start = time.perf_counter()
+            for _ in range(requests):
+                response = client.get(url, headers=headers)
+                response.close()
+            elapsed = (time.perf_counter() - start) / requests
+            print(f"{name:>10} {label:>12} {response.status_code:>7} {elapsed * 1000:>11.2f}  {response.headers['Cache-Control']}")
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    ingest = subparsers.add_parser('ingest', help='events/s ingested by /collect')
+    ingest.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    ingest.add_argument('--repeats', type=int, default=5)
+    memory = subparsers.add_parser('memory', help='peak memory of the video encoder vs. session length')
+    memory.add_argument('--frames', type=int, nargs='+', default=[50, 500])
+    memory.add_argument('--tolerance', type=float, default=1.5)
+    timeline = subparsers.add_parser('timeline', help='frame -> event lookup on synthetic sessions')
+    timeline.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    timeline.add_argument('--fps', type=int, default=15)
+    timeline.add_argument('--sample-frames', type=int, default=200)
+    storage = subparsers.add_parser('storage', help='size and load latency of row vs packed mousemove storage')
+    storage.add_argument('--points', type=int, default=100000)
+    storage.add_argument('--batch', type=int, default=500)
+    stream = subparsers.add_parser('stream', help='time to first byte and peak memory of GET /session/<id>')
+    stream.add_argument('--points', type=int, default=100000)
+    stream.add_argument('--batch', type=int, default=500)
+    heatmap = subparsers.add_parser('heatmap', help='precomputed per-URL heatmap vs aggregating sessions on request')
+    heatmap.add_argument('--sessions', type=int, default=20)
+    heatmap.add_argument('--points', type=int, default=50000)
+    heatmap.add_argument('--batch', type=int, default=500)
+    overlay = subparsers.add_parser('overlay', help='per-frame cost of the trail, cursor and HUD overlays')
+    overlay.add_argument('--frames', type=int, default=2000)
+    overlay.add_argument('--trail-length', type=int, default=30)
+    encoder = subparsers.add_parser('encoder', help='speed and output size of the OpenCV and ffmpeg encoders')
+    encoder.add_argument('--frames', type=int, default=900)
+    encoder.add_argument('--fps', type=int, default=15)
+    retention = subparsers.add_parser('retention', help='lock hold time of batched archiving, and downsampling')
+    retention.add_argument('--sessions', type=int, default=100)
+    retention.add_argument('--points', type=int, default=2000)
+    retention.add_argument('--batch', type=int, default=10)
+    load = subparsers.add_parser('load', help='p50/p99 latency of concurrent /collect against a gunicorn server')
+    load.add_argument('--workers', type=int, default=4)
+    load.add_argument('--threads', type=int, default=1)
+    load.add_argument('--concurrency', type=int, default=16)
+    load.add_argument('--requests', type=int, default=2000)
+    load.add_argument('--events', type=int, default=100)
+    load.add_argument('--sessions', type=int, default=50)
+    load.add_argument('--async-ingest', action='store_true', help="use each worker's background writer")
+    capture = subparsers.add_parser('capture', help='frames/s of the screenshot and screencast capture backends (needs Chrome)')
+    capture.add_argument('--seconds', type=int, default=10)
+    capture.add_argument('--fps', type=int, default=15)
+    media = subparsers.add_parser('media', help='thumbnail size and cost, and full/304/206 responses of /video/<id>')
+    media.add_argument('--frames', type=int, default=450)
+    media.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+    if args.benchmark == 'ingest':
+        bench_ingest(args.sizes, args.repeats)
+    elif args.benchmark == 'memory':
+        sys.exit(0 if bench_memory(args.frames, args.tolerance) else 1)
+    elif args.benchmark == 'timeline':
+        bench_timeline(args.sizes, args.fps, args.sample_frames)
+    elif args.benchmark == 'storage':
+        bench_storage(args.points, args.batch)
+    elif args.benchmark == 'stream':
+        bench_stream(args.points, args.batch)
+    elif args.benchmark == 'heatmap':
+        bench_heatmap(args.sessions, args.points, args.batch)
+    elif args.benchmark == 'overlay':
+        bench_overlay(args.frames, args.trail_length)
+    elif args.benchmark == 'encoder':
+        bench_encoder(args.frames, args.fps)
+    elif args.benchmark == 'retention':
+        bench_retention(args.sessions, args.points, args.batch)
+    elif args.benchmark == 'load':
+        sys.exit(0 if bench_load(args.workers, args.threads, args.concurrency, args.requests, args.events,
+                                 args.sessions, args.async_ingest) else 1)
+    elif args.benchmark == 'capture':
+        bench_capture(args.seconds, args.fps)
+    elif args.benchmark == 'media':
+        bench_media(args.frames, args.requests)
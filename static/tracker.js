@@ -1,47 +1,153 @@
 // static/tracker.js
 (function () {
+  // Override any of these with window.MOUSEFLOW_CONFIG before loading the script
+  const config = Object.assign({
+    endpoint: 'http://127.0.0.1:5000/collect',
+    flushInterval: 10000, // 10 secs between uploads
+    moveInterval: 50,     // at most 20 mousemoves per second
+    scrollInterval: 100   // at most 10 scroll positions per second
+  }, window.MOUSEFLOW_CONFIG || {});
+
+  // Events are kept as [typeIndex, timestamp, x, y] and delta-encoded on flush
+  const TYPES = ['mousemove', 'click', 'scroll'];
+  const MOVE = 0, CLICK = 1, SCROLL = 2;
   let events = [];
 
-  const record = (type, e) => {
-    console.log(type);
-    
-    const event = {
-      type,
-      timestamp: Date.now(),
-      x: e.clientX || null,
-      y: e.clientY || null
+  // One token per tab visit so the server can stitch the 10s flushes from each page into one session
+  const SESSION_KEY = 'mouseflow_session_token';
+  const newToken = () => (window.crypto && crypto.randomUUID)
+    ? crypto.randomUUID()
+    : Date.now().toString(36) + Math.random().toString(36).slice(2);
+  let sessionToken;
+  try {
+    sessionToken = sessionStorage.getItem(SESSION_KEY);
+    if (!sessionToken) {
+      sessionToken = newToken();
+      sessionStorage.setItem(SESSION_KEY, sessionToken);
+    }
+  } catch (err) {
+    sessionToken = newToken();
+  }
+
+  // Coalesce a burst of DOM events into at most one sample per animation frame and interval
+  const sampler = (type, interval, read) => {
+    let pending = null;
+    let scheduled = false;
+    let lastAt = 0;
+    const take = () => {
+      scheduled = false;
+      if (!pending) return;
+      const now = Date.now();
+      if (now - lastAt < interval) {
+        scheduled = true;
+        requestAnimationFrame(take);
+        return;
+      }
+      lastAt = now;
+      events.push([type, now, pending[0], pending[1]]);
+      pending = null;
+    };
+    return {
+      capture(e) {
+        pending = read(e);
+        if (!scheduled) {
+          scheduled = true;
+          requestAnimationFrame(take);
+        }
+      },
+      flush() {
+        if (pending) {
+          events.push([type, Date.now(), pending[0], pending[1]]);
+          pending = null;
+        }
+      }
     };
-    events.push(event);
   };
 
-  document.addEventListener('click', e => record('click', e));
-  document.addEventListener('mousemove', e => record('mousemove', e));
-  
-  window.addEventListener('scroll', function(e) {
-    console.log('scroll', window.scrollX, window.scrollY);
+  const moves = sampler(MOVE, config.moveInterval, e => [e.clientX, e.clientY]);
+  const scrolls = sampler(SCROLL, config.scrollInterval, () => {
     const maxScrollX = document.documentElement.scrollWidth - window.innerWidth;
     const maxScrollY = document.documentElement.scrollHeight - window.innerHeight;
     const scrollPercentX = maxScrollX > 0 ? (window.scrollX / maxScrollX) * 100 : 0;
     const scrollPercentY = maxScrollY > 0 ? (window.scrollY / maxScrollY) * 100 : 0;
-    events.push({
-        type: 'scroll',
-        timestamp: Date.now(),
-        x: Math.round(scrollPercentX * 100) / 100,
-        y: Math.round(scrollPercentY * 100) / 100,
-        data: null
+    // Hundredths of a percent, so the server can keep two decimals
+    return [Math.round(scrollPercentX * 100), Math.round(scrollPercentY * 100)];
+  });
+
+  document.addEventListener('mousemove', e => moves.capture(e), { passive: true });
+  window.addEventListener('scroll', e => scrolls.capture(e), { passive: true });
+  document.addEventListener('click', e => {
+    moves.flush();
+    events.push([CLICK, Date.now(), e.clientX, e.clientY]);
+  });
+
+  // Compact format: e is a flat [type, dt, dx, dy, ...] list; pointer and scroll
+  // coordinates are delta-encoded against separate running positions
+  const encode = batch => {
+    const e = [];
+    const last = [[0, 0], [0, 0]];
+    let lastT = batch[0][1];
+    for (const [type, t, x, y] of batch) {
+      const position = last[type === SCROLL ? 1 : 0];
+      e.push(type, t - lastT, x - position[0], y - position[1]);
+      lastT = t;
+      position[0] = x;
+      position[1] = y;
+    }
+    return JSON.stringify({
+      v: 2,
+      t0: batch[0][1],
+      types: TYPES,
+      e,
+      session_token: sessionToken,
+      url: window.location.href  // Send the current URL
     });
-});
+  };
 
-  setInterval(() => {
-    if (events.length === 0) return;
-    fetch('http://127.0.0.1:5000/collect', {
+  const send = body => {
+    if (!window.CompressionStream) {
+      return fetch(config.endpoint, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body
+      });
+    }
+    const stream = new Blob([body]).stream().pipeThrough(new CompressionStream('gzip'));
+    return new Response(stream).arrayBuffer().then(gzipped => fetch(config.endpoint, {
       method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ 
-        events,
-        url: window.location.href  // Send the current URL
-      })
-    }).catch(console.error);
+      headers: { 'Content-Type': 'application/json', 'Content-Encoding': 'gzip' },
+      body: gzipped
+    }));
+  };
+
+  const takeBatch = () => {
+    moves.flush();
+    scrolls.flush();
+    if (events.length === 0) return null;
+    const batch = events;
     events = [];
-  }, 10000); //1 min, 60 secs, 60000. 10000 = 10 secs
+    return batch;
+  };
+
+  setInterval(() => {
+    const batch = takeBatch();
+    if (batch) send(encode(batch)).catch(console.error);
+  }, config.flushInterval);
+
+  // The page may be gone before a compressed fetch resolves, so hand the last
+  // batch to the browser uncompressed; text/plain keeps sendBeacon CORS-simple
+  const flushOnExit = () => {
+    const batch = takeBatch();
+    if (!batch) return;
+    const body = encode(batch);
+    const queued = navigator.sendBeacon
+      && navigator.sendBeacon(config.endpoint, new Blob([body], { type: 'text/plain' }));
+    if (!queued) {
+      fetch(config.endpoint, { method: 'POST', body, keepalive: true }).catch(console.error);
+    }
+  };
+  window.addEventListener('pagehide', flushOnExit);
+  document.addEventListener('visibilitychange', () => {
+    if (document.visibilityState === 'hidden') flushOnExit();
+  });
 })();
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Checks for /collect validation and packed mousemove storage; run with python -m pytest test_app.py
+"""
+import datetime
+import os
+import tempfile
+import time
+
+os.environ['MOUSEFLOW_DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.sqlite3')
+os.environ['MOUSEFLOW_INGEST_ASYNC'] = '0'
+os.environ['MOUSEFLOW_CHROME_WARM'] = '0'
+
+import pytest
+import app as mouseflow
+from app import app, db, PKT, MoveChunk, Session, load_session_events, insert_events, unpack_moves
+
+
+@pytest.fixture(autouse=True)
+def database():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        yield
+        db.session.remove()
+
+
+def add_session():
+    session = Session(url='https://example.com', user_agent='test')
+    db.session.add(session)
+    db.session.commit()
+    return session.id
+
+
+def test_wide_mousemove_batch_splits_chunks():
+    session_id = add_session()
+    start = datetime.datetime(2026, 1, 1)
+    later = start + datetime.timedelta(days=40)
+    insert_events(session_id, [
+        {'event_type': 'mousemove', 'timestamp': t, 'x': x, 'y': x, 'additional_data': None}
+        for t, x in [(start, 1), (start + datetime.timedelta(milliseconds=16), 2), (later, 3)]])
+    db.session.commit()
+    chunks = MoveChunk.query.filter_by(session_id=session_id).order_by(MoveChunk.start_time).all()
+    assert [chunk.start_time for chunk in chunks] == [start, later]
+    assert [unpack_moves(chunk)[0].tolist() for chunk in chunks] == [[0, 16], [0]]
+    events = load_session_events(session_id)
+    assert [evt.timestamp for evt in events] == [start, start + datetime.timedelta(milliseconds=16), later]
+    assert [evt.x for evt in events] == [1, 2, 3]
+
+
+def test_pack_move_columns_rejects_overflow():
+    with pytest.raises(ValueError):
+        mouseflow.pack_move_columns(mouseflow.np.array([[0, 2 ** 31], [0, 0], [0, 0]]))
+
+
+def test_stream_since_keeps_overlapping_chunks_in_order():
+    session_id = add_session()
+    start = datetime.datetime(2026, 1, 1)
+    # One chunk per batch; the second falls entirely before ?since= and the third overlaps the first
+    for batch in [[0, 70, 80], [50, 60], [72, 90]]:
+        insert_events(session_id, [
+            {'event_type': 'mousemove', 'timestamp': start + datetime.timedelta(milliseconds=ms), 'x': ms, 'y': 0,
+             'additional_data': None} for ms in batch])
+    db.session.commit()
+    since = start + datetime.timedelta(milliseconds=70)
+    assert [evt[2] for evt in mouseflow.stream_packed_moves(session_id, since)] == [70, 72, 80, 90]
+    assert [evt[2] for evt in mouseflow.stream_packed_moves(session_id)] == [0, 50, 60, 70, 72, 80, 90]
+
+
+def post_events(timestamps):
+    return app.test_client().post('/collect', json={
+        'url': 'https://example.com', 'session_token': 'window',
+        'events': [{'type': 'click', 'timestamp': ms, 'x': 1, 'y': 2} for ms in timestamps]})
+
+
+def test_collect_rejects_timestamps_outside_the_window():
+    now_ms = int(time.time() * 1000)
+    day_ms = 24 * 3600 * 1000
+    for timestamps in [[0, now_ms], [now_ms, now_ms + 2 * day_ms], [now_ms - 8 * day_ms]]:
+        response = post_events(timestamps)
+        assert response.status_code == 400
+        assert 'outside the accepted time window' in response.get_json()['message']
+    assert Session.query.count() == 0
+    assert post_events([now_ms - 6 * day_ms, now_ms, now_ms + 3600 * 1000]).status_code == 200
+    assert [evt.timestamp for evt in load_session_events(Session.query.one().id)] == sorted(
+        datetime.datetime.fromtimestamp(ms / 1000, tz=PKT).replace(tzinfo=None)
+        for ms in [now_ms - 6 * day_ms, now_ms, now_ms + 3600 * 1000])
+
+
+def test_init_db_adds_missing_indexes_to_existing_tables():
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql('DROP INDEX ix_event_session_id_timestamp')
+        connection.exec_driver_sql('DROP INDEX ix_session_token_last_seen')
+    result = app.test_cli_runner().invoke(args=['init-db'])
+    assert result.exit_code == 0, result.output
+    assert '2 indexes created' in result.output
+    inspector = mouseflow.sqla_inspect(db.engine)
+    assert 'ix_event_session_id_timestamp' in {index['name'] for index in inspector.get_indexes('event')}
+    assert 'ix_session_token_last_seen' in {index['name'] for index in inspector.get_indexes('session')}
+    assert '0 indexes created' in app.test_cli_runner().invoke(args=['init-db']).output
+
+
+def test_compact_batch_rejects_bad_type_indexes():
+    now_ms = int(time.time() * 1000)
+    for type_idx in [-1, True, 2, 1.0, None]:
+        response = app.test_client().post('/collect', json={
+            'v': mouseflow.COMPACT_FORMAT_VERSION, 'url': 'https://example.com', 'session_token': 'compact',
+            'types': ['click', 'mousemove'], 't0': now_ms, 'e': [0, 0, 1, 1, type_idx, 10, 1, 1]})
+        assert response.status_code == 400
+        assert response.get_json()['message'] == 'invalid compact event at index 1'
+    assert Session.query.count() == 0